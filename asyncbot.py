@@ -0,0 +1,584 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import sys
+import threading
+import time
+
+from constants import logmessage_types, internal_submessage_types, controlmessage_types, cronmessage_types, sendpriority_types
+
+import botcmd
+import cron
+import floodcontrol
+import ircbot
+import line_handling
+import logger
+import offload
+import tracing
+
+# asyncio mode
+# Runs the server connections, timers, logging and line handling as tasks on a single event loop. Handlers
+# from botcmd are ordinary blocking functions, so they are run on a thread pool. ircbot.API works unchanged,
+# since the objects here provide everything it uses from ServerThread in a thread-safe way
+
+class LoopChannel:
+	"""Stand-in for channel.Channel that feeds an asyncio.Queue. send() can be called from any thread."""
+
+	def __init__(self, loop):
+		self.loop = loop
+		self.queue = asyncio.Queue()
+
+	def send(self, message):
+		if in_loop_thread(self.loop):
+			self.queue.put_nowait(message)
+		else:
+			self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+	async def recv(self):
+		return await self.queue.get()
+
+	async def recv_many(self):
+		"""Returns a list of all the messages waiting, waiting for at least one"""
+		messages = [await self.queue.get()]
+		while not self.queue.empty():
+			messages.append(self.queue.get_nowait())
+
+		return messages
+
+	def qsize(self):
+		return self.queue.qsize()
+
+class LoopCron:
+	"""Stand-in for a cron control channel, so that the functions of the cron module work with it.
+	Events are run with the timers of the event loop instead of the cron thread."""
+
+	def __init__(self, loop):
+		self.loop = loop
+
+		# (channel, message) → list of [event, timer handle of the loop] entries
+		self.events_by_key = {}
+		# cron.Timer → entry of its event
+		self.events_by_timer = {}
+
+	def send(self, message):
+		if in_loop_thread(self.loop):
+			self.handle(message)
+		else:
+			self.loop.call_soon_threadsafe(self.handle, message)
+
+	def handle(self, message):
+		command_type, *arguments = message
+
+		if command_type == cronmessage_types.quit:
+			for entries in list(self.events_by_key.values()):
+				for entry in list(entries):
+					self.delete_entry(entry)
+
+		elif command_type == cronmessage_types.schedule:
+			event, = arguments
+			self.add_event(event)
+
+		elif command_type == cronmessage_types.delete:
+			event, = arguments
+			self.delete_event(event)
+
+		elif command_type == cronmessage_types.reschedule:
+			event, = arguments
+			self.delete_event(event)
+			self.add_event(event)
+
+		elif command_type == cronmessage_types.cancel:
+			timer, = arguments
+			if timer in self.events_by_timer:
+				self.delete_entry(self.events_by_timer[timer])
+
+		elif command_type == cronmessage_types.rearm:
+			timer, new_time = arguments
+			if timer in self.events_by_timer:
+				self.delete_entry(self.events_by_timer[timer])
+			self.add_event(timer.event._replace(time = new_time))
+
+		else:
+			assert False #unreachable
+
+	def add_event(self, event):
+		# Event times come from time.monotonic(), same as the event loop's clock on the platforms we run on
+		entry = [event, None]
+		entry[1] = self.loop.call_at(event.time, self.run_event, entry)
+
+		self.events_by_key.setdefault((event.channel, event.message), []).append(entry)
+		if event.timer is not None:
+			self.events_by_timer[event.timer] = entry
+
+	def queue_size(self):
+		"""Number of events waiting to be run"""
+		return sum(len(entries) for entries in list(self.events_by_key.values()))
+
+	def forget_entry(self, entry):
+		event = entry[0]
+
+		key = (event.channel, event.message)
+		entries = self.events_by_key[key]
+
+		entries.remove(entry)
+		if len(entries) == 0:
+			del self.events_by_key[key]
+
+		if event.timer is not None:
+			del self.events_by_timer[event.timer]
+
+	def delete_entry(self, entry):
+		self.forget_entry(entry)
+		entry[1].cancel()
+
+	def delete_event(self, event):
+		# Only the earliest event with same channel and message is deleted
+		entries = self.events_by_key.get((event.channel, event.message))
+		if entries:
+			self.delete_entry(min(entries, key = lambda entry: entry[0].time))
+
+	def run_event(self, entry):
+		event = entry[0]
+		self.forget_entry(entry)
+
+		run, next_event = cron.next_occurrence(event, self.loop.time())
+
+		if next_event is not None:
+			self.add_event(next_event)
+
+		if run:
+			event.channel.send(event.message)
+
+# AsyncServer(server, loop, cron, logging_channel, dispatcher)
+# One server connection, with the attributes ircbot.API needs
+class AsyncServer:
+	def __init__(self, server, loop, cron, logging_channel, dispatcher):
+		self.server = server
+		self.loop = loop
+		self.cron_control_channel = cron
+		self.logging_channel = logging_channel
+		self.dispatcher = dispatcher
+
+		self.control_channel = LoopChannel(loop)
+
+		self.nick = None
+		self.hostmask = None
+		self.nick_lock = threading.Lock()
+
+		self.channels = set()
+		self.channels_lock = threading.Lock()
+
+		# Lines waiting to be sent, by priority. send_ready is set when a line is added
+		self.writer = None
+		self.send_lines = None
+		self.send_ready = asyncio.Event()
+
+		self.last_activity = 0
+
+		self.lines_received = 0
+		self.lines_sent = 0
+
+	def log(self, *message):
+		self.logging_channel.send(message)
+
+	def error(self, message):
+		self.log(logmessage_types.internal, internal_submessage_types.error, message)
+
+	def send_line_raw(self, line, priority = None):
+		line, priority, trace = ircbot.outgoing_line(line, priority)
+
+		# Never blocks, the writer task takes care of flood control
+		if in_loop_thread(self.loop):
+			self.queue_line(line, priority, trace)
+		else:
+			self.loop.call_soon_threadsafe(self.queue_line, line, priority, trace)
+
+	def queue_line(self, line, priority, trace):
+		# Lines sent when there is no connection are dropped
+		if self.send_lines is not None:
+			self.send_lines[priority].append((line, time.monotonic(), trace))
+			self.send_ready.set()
+		elif trace is not None:
+			trace.release()
+
+	async def wait_for_line(self, timeout = None):
+		self.send_ready.clear()
+		try:
+			await asyncio.wait_for(self.send_ready.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+	async def write_lines(self):
+		# Urgent lines are sent right away, the rest as the token bucket allows
+		bucket = floodcontrol.TokenBucket(self.server.flood_rate, self.server.flood_burst)
+
+		# Let registration and joining channels through without waiting
+		bucket.add(self.server.register_burst)
+		urgent_lines = self.send_lines[sendpriority_types.urgent]
+		normal_lines = self.send_lines[sendpriority_types.normal]
+
+		while True:
+			if len(urgent_lines) > 0:
+				line, queued, trace = urgent_lines.popleft()
+				floodcontrol.send_wait.observe(time.monotonic() - queued, sendpriority_types.urgent.name)
+
+			elif len(normal_lines) > 0:
+				wait = bucket.take(floodcontrol.is_registration(normal_lines[0][0]))
+				if wait > 0:
+					# Wait for a token, or for an urgent line to come in
+					await self.wait_for_line(wait)
+					continue
+
+				line, queued, trace = normal_lines.popleft()
+				floodcontrol.send_wait.observe(time.monotonic() - queued, sendpriority_types.normal.name)
+
+			else:
+				await self.wait_for_line()
+				continue
+
+			try:
+				self.writer.write(line + b'\r\n')
+				await self.writer.drain()
+			finally:
+				# Also when the connection breaks or the task is cancelled
+				if trace is not None:
+					trace.release('write')
+
+			self.lines_sent += 1
+
+			if ircbot.logged_when_sent(line):
+				self.log(logmessage_types.sent, line)
+
+	async def read_lines(self, reader):
+		while True:
+			try:
+				line = await reader.readuntil(b'\r\n')
+			except asyncio.IncompleteReadError:
+				self.error('Empty read')
+				return
+			except asyncio.LimitOverrunError:
+				self.error('Line too long')
+				return
+
+			self.last_activity = self.loop.time()
+			ircbot.handle_server_line(self, line[:-2], time.monotonic(), self.dispatcher.dispatch)
+
+			# With the block overflow policy, stop reading until the line's handlers fit in their queues
+			await self.dispatcher.wait_for_room(self.api)
+
+	def stats(self):
+		"""Returns an ircbot.NetworkStats for this network"""
+		connected = self.send_lines is not None
+		send_queue = 0
+		if connected:
+			send_queue = sum(len(lines) for lines in self.send_lines.values())
+
+		with line_handling.dropped_lines_lock:
+			dropped_lines = line_handling.dropped_lines[self.server.name]
+
+		return ircbot.NetworkStats(connected, self.lines_received, self.lines_sent, send_queue, dropped_lines)
+
+	async def keepalive(self):
+		# Send a PING after 3 minutes of no activity, and give up if there is still nothing 2 minutes after that
+		while True:
+			idle = self.loop.time() - self.last_activity
+
+			if idle >= 5 * 60:
+				self.error('Ping timeout')
+				return
+
+			elif idle >= 3 * 60:
+				self.send_line_raw(b'PING :foo')
+				await asyncio.sleep(5 * 60 - idle)
+
+			else:
+				await asyncio.sleep(3 * 60 - idle)
+
+	async def handle_control(self):
+		# Returns True for reconnecting and False for quitting
+		while True:
+			command_type, *arguments = await self.control_channel.recv()
+
+			if command_type == controlmessage_types.quit:
+				return False
+
+			elif command_type == controlmessage_types.reconnect:
+				return True
+
+			elif command_type == controlmessage_types.send_line:
+				assert len(arguments) == 1
+				irc_command, space, arguments = arguments[0].encode('utf-8').partition(b' ')
+				line = irc_command.upper() + space + arguments
+				self.send_line_raw(line)
+
+			else:
+				error_message = 'Unknown control message: %s' % repr((command_type, *arguments))
+				self.error(error_message)
+
+	async def wait_for_reconnect(self):
+		# Returns True for reconnecting and False for quitting
+		timer = asyncio.ensure_future(asyncio.sleep(60))
+		control = asyncio.ensure_future(self.control_channel.recv())
+
+		while True:
+			await asyncio.wait([timer, control], return_when = asyncio.FIRST_COMPLETED)
+
+			if timer.done():
+				control.cancel()
+				return True
+
+			command_type, *arguments = control.result()
+			if command_type == controlmessage_types.reconnect:
+				timer.cancel()
+				return True
+
+			elif command_type == controlmessage_types.quit:
+				timer.cancel()
+				return False
+
+			else:
+				error_message = 'Control message not supported when not connected: %s' % repr((command_type, *arguments))
+				self.error(error_message)
+				control = asyncio.ensure_future(self.control_channel.recv())
+
+	async def run(self):
+		while True:
+			# Connect to given server
+			try:
+				reader, self.writer = await asyncio.open_connection(self.server.host, self.server.port, limit = 64 * 1024 + self.server.read_size)
+			except OSError:
+				self.error("Can't connect to %s:%s" % (self.server.host, self.server.port))
+
+				# Try reconnecting in a minute
+				if await self.wait_for_reconnect():
+					continue
+				else:
+					break
+
+			self.send_lines = {sendpriority_types.urgent: collections.deque(), sendpriority_types.normal: collections.deque()}
+			self.last_activity = self.loop.time()
+
+			# Create an API object to give to outside line handler
+			self.api = ircbot.API(self)
+			self.hostmask = None
+
+			tasks = [
+				asyncio.ensure_future(self.write_lines()),
+				asyncio.ensure_future(self.read_lines(reader)),
+				asyncio.ensure_future(self.keepalive()),
+			]
+			control = asyncio.ensure_future(self.handle_control())
+
+			# Run initialization
+			self.send_line_raw(b'USER %s a a :%s' % (self.server.username.encode('utf-8'), self.server.realname.encode('utf-8')))
+
+			# Set up nick
+			self.api.nick(self.server.nick.encode('utf-8'))
+
+			# Run the on_connect hook, to allow further setup
+			botcmd.on_connect(irc = self.api)
+
+			# Join channels, packing them into as few lines as we can
+			self.api.join_many(*ircbot.encode_channels(self.server))
+
+			# Run until the connection breaks or we are told to quit or reconnect
+			await asyncio.wait(tasks + [control], return_when = asyncio.FIRST_COMPLETED)
+			reconnecting = not control.done() or control.result()
+
+			# A task that failed ends the connection like a broken one, but say why
+			for task in tasks:
+				if task.done() and not task.cancelled() and task.exception() is not None:
+					self.error('Error in connection: %s' % repr(task.exception()))
+
+			for task in tasks + [control]:
+				task.cancel()
+
+			if not reconnecting:
+				# Run bot cleanup code
+				botcmd.on_quit(irc = self.api)
+				quit_line = b'QUIT :%s exiting normally' % self.server.username.encode('utf-8')
+			else:
+				quit_line = b'QUIT :Reconnecting'
+
+			# Tell the server, skipping the queue since we won't be waiting for it
+			try:
+				self.writer.write(quit_line + b'\r\n')
+				await self.writer.drain()
+				self.lines_sent += 1
+				self.log(logmessage_types.sent, quit_line)
+			except OSError:
+				self.error('Broken socket/pipe or timeout')
+
+			self.writer.close()
+
+			# The lines that didn't get sent are dropped, along with their references to traces
+			for lines in self.send_lines.values():
+				for line, queued, trace in lines:
+					if trace is not None:
+						trace.release('dropped')
+
+			self.send_lines = None
+
+			if not reconnecting:
+				break
+
+# run_traced(trace, handler, arguments, irc)
+# Run handler(**arguments, irc = irc) in an executor thread, with trace as its current trace
+def run_traced(trace, handler, arguments, irc):
+	with tracing.activate(trace):
+		handler(**arguments, irc = irc)
+
+class AsyncDispatcher:
+	"""Line handling sharded like line_handling.dispatch: each shard has a queue of [dispatch] queue_size items and a
+	task running their handlers one at a time on the executor. Full queues are dealt with by the overflow policy."""
+
+	def __init__(self, loop, executor):
+		self.loop = loop
+		self.executor = executor
+
+		self.shard_queues = [asyncio.Queue(line_handling.queue_size) for _ in range(line_handling.workers)]
+		self.tasks = [loop.create_task(self.run(shard_queue)) for shard_queue in self.shard_queues]
+
+		# id(irc) → (shard queue, work) that didn't fit with the block policy, in order
+		self.blocked = collections.defaultdict(collections.deque)
+
+	def dispatch(self, key, handler, arguments, *, irc, trace = None):
+		"""Queue handler(**arguments, irc = irc) on the shard for key, like line_handling.dispatch"""
+		shard_queue = self.shard_queues[hash((id(irc), key)) % len(self.shard_queues)]
+		work = (irc, handler, arguments, trace)
+
+		if trace is not None:
+			trace.hold('dispatch')
+
+		# Keep the order behind work of the same network that is already waiting for room
+		if len(self.blocked[id(irc)]) == 0:
+			try:
+				shard_queue.put_nowait(work)
+				return
+			except asyncio.QueueFull:
+				pass
+
+		if line_handling.overflow == 'block':
+			self.blocked[id(irc)].append((shard_queue, work))
+
+		elif line_handling.overflow == 'drop-oldest':
+			# Everything runs on the loop, so the queue is still full and nothing can take the room meanwhile
+			oldest_irc, _, _, oldest_trace = shard_queue.get_nowait()
+			line_handling.drop_work(oldest_irc, oldest_trace)
+			shard_queue.put_nowait(work)
+
+		else:
+			line_handling.drop_work(irc, trace)
+
+	async def wait_for_room(self, irc):
+		"""Wait until the work for irc that didn't fit in its queue has been queued"""
+		blocked = self.blocked[id(irc)]
+		while len(blocked) > 0:
+			shard_queue, work = blocked[0]
+			await shard_queue.put(work)
+			blocked.popleft()
+
+	async def run(self, shard_queue):
+		while True:
+			irc, handler, arguments, trace = await shard_queue.get()
+
+			try:
+				await self.loop.run_in_executor(self.executor, functools.partial(run_traced, trace, handler, arguments, irc))
+			except Exception as err:
+				# Keep the shard running for the next item
+				irc.error('Error in %s: %s' % (handler.__name__, repr(err)))
+
+	def queue_depths(self):
+		"""Number of items waiting in each shard"""
+		return [shard_queue.qsize() for shard_queue in self.shard_queues]
+
+	def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+async def log_messages(logging_channel):
+	output = logger.open_output()
+
+	quitting = False
+	while not quitting:
+		# Write everything that has queued up at once
+		messages = await logging_channel.recv_many()
+
+		for index, message in enumerate(messages):
+			if logger.is_quit(message):
+				messages = messages[:index + 1]
+				quitting = True
+				break
+
+		logger.write_messages(output, messages, logging_channel.take_dropped())
+
+	output.close()
+
+class ConsoleThread(threading.Thread):
+	"""Reads lines from stdin into a LoopChannel. Daemonic, since it can be blocked reading when the bot quits."""
+
+	def __init__(self, console_channel):
+		self.console_channel = console_channel
+
+		threading.Thread.__init__(self, daemon = True)
+
+	def run(self):
+		for line in sys.stdin:
+			self.console_channel.send(line.rstrip('\n'))
+
+async def read_console(loop, servers):
+	console_channel = LoopChannel(loop)
+	ConsoleThread(console_channel).start()
+
+	# Network name → server
+	networks = {server.server.name: server for server in servers}
+
+	# Reloading the lexicon takes a while, so it is done in an executor thread
+	reload_lexicon = lambda: loop.run_in_executor(None, botcmd.reload_lexicon)
+
+	while len(networks) > 0:
+		ircbot.console_command(await console_channel.recv(), networks, reload_lexicon)
+
+def in_loop_thread(loop):
+	try:
+		return asyncio.get_running_loop() is loop
+	except RuntimeError:
+		return False
+
+async def main(config, servers):
+	loop = asyncio.get_running_loop()
+
+	# One executor thread for each shard, like the worker threads of the threaded mode
+	line_handling.configure(config = config)
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers = line_handling.workers)
+	dispatcher = AsyncDispatcher(loop, executor)
+	line_handling.queue_depths = dispatcher.queue_depths
+
+	cron = LoopCron(loop)
+	logging_channel = logger.LogQueue(LoopChannel(loop))
+	logger_task = asyncio.ensure_future(log_messages(logging_channel))
+
+	# All the networks share the cron, the logger, the line handling shards and the lexicon
+	async_servers = [AsyncServer(server, loop, cron, ircbot.network_log(logging_channel, server), dispatcher) for server in servers]
+	connections = [asyncio.ensure_future(server.run()) for server in async_servers]
+
+	ircbot.register_metrics({server.server.name: server for server in async_servers}, logging_channel, cron)
+	console = asyncio.ensure_future(read_console(loop, async_servers))
+
+	# Run until all the connections have quit
+	await asyncio.wait(connections)
+
+	console.cancel()
+	cron.send((cronmessage_types.quit,))
+	logging_channel.send((logmessage_types.internal, internal_submessage_types.quit))
+	await logger_task
+
+	dispatcher.stop()
+	executor.shutdown(wait = False)
+	offload.shutdown()
+
+# run(config, servers)
+# Run the bot on the given servers in asyncio mode until told to quit
+def run(config, servers):
+	asyncio.run(main(config, servers))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import configparser
+import itertools
+import json
+import multiprocessing
+import sys
+
+import botcmd
+
+# Offline batch mode
+# Runs bot commands read from files or stdin through botcmd.handle_command, the same as the bot would over IRC, and
+# writes the results as TSV or JSON lines. Opens no connections and starts none of the bot's threads, only reads the
+# lexicon files in the current directory
+
+# initialize(config_path)
+# Load the lexicon, with the [lexicon] settings from config_path if it is not None. Run once in each process
+def initialize(config_path):
+	config = None
+	if config_path is not None:
+		config = configparser.ConfigParser()
+		config.read(config_path)
+
+	botcmd.initialize(config = config)
+
+# handle_commands(commands) → results
+def handle_commands(commands):
+	return [botcmd.handle_command(command) for command in commands]
+
+# read_commands(files, command) → iterator of commands
+# Stream the non-empty lines of files, each prefixed with command if it is not None
+def read_commands(files, command):
+	for f in files:
+		for line in f:
+			line = line.rstrip('\r\n')
+			if line.strip() == '':
+				continue
+
+			if command is not None:
+				line = command + ' ' + line
+
+			yield line
+
+# chunks(iterable, size) → iterator of lists
+def chunks(iterable, size):
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, size))
+		if len(chunk) == 0:
+			return
+
+		yield chunk
+
+# run(commands, processes, chunk_size, config_path) → iterator of (command, result)
+# Handle the commands in order, in this process or on a pool of processes. Only a few chunks are in flight at once,
+# so arbitrarily large inputs can be streamed through. The pool processes are initialized with config_path
+def run(commands, processes, chunk_size, config_path):
+	if processes <= 1:
+		for chunk in chunks(commands, chunk_size):
+			yield from zip(chunk, handle_commands(chunk))
+
+		return
+
+	with multiprocessing.Pool(processes, initializer = initialize, initargs = (config_path,)) as pool:
+		pending = collections.deque()
+
+		for chunk in chunks(commands, chunk_size):
+			pending.append((chunk, pool.apply_async(handle_commands, (chunk,))))
+
+			# Keep every process busy, but don't read further ahead than that
+			if len(pending) >= 2 * processes:
+				chunk, results = pending.popleft()
+				yield from zip(chunk, results.get())
+
+		while len(pending) > 0:
+			chunk, results = pending.popleft()
+			yield from zip(chunk, results.get())
+
+# escape_tsv(text) → text
+# Escape the characters that would break up a TSV field, as in the text format of PostgreSQL COPY
+def escape_tsv(text):
+	return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def format_tsv(command, result):
+	return escape_tsv(command) + '\t' + escape_tsv(result) + '\n'
+
+def format_json(command, result):
+	return json.dumps({'command': command, 'result': result}, ensure_ascii = False) + '\n'
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Run bot commands from files or stdin, without connecting to IRC')
+	parser.add_argument('files', nargs = '*', default = ['-'], help = 'files with one command per line, - for stdin (default)')
+	parser.add_argument('--command', help = 'run this command on each line, like --command gloss for a file of sentences')
+	parser.add_argument('--format', choices = ['tsv', 'json'], default = 'tsv', help = 'TSV of command and result, or JSON lines (default tsv)')
+	parser.add_argument('--output', help = 'write the results to this file instead of stdout')
+	parser.add_argument('--processes', type = int, default = 1, help = 'processes to handle the commands on (default 1, no pool)')
+	parser.add_argument('--chunk-size', type = int, default = 64, help = 'commands sent to a process at a time')
+	parser.add_argument('--config', help = 'read the [lexicon] settings from this file')
+	options = parser.parse_args()
+
+	files = [sys.stdin if path == '-' else open(path, 'r', encoding = 'utf-8') for path in options.files]
+	output = sys.stdout if options.output is None else open(options.output, 'w', encoding = 'utf-8')
+	format_result = format_json if options.format == 'json' else format_tsv
+
+	# With a pool, each process loads its own lexicon
+	if options.processes <= 1:
+		initialize(options.config)
+
+	try:
+		for command, result in run(read_commands(files, options.command), options.processes, options.chunk_size, options.config):
+			output.write(format_result(command, result))
+
+	finally:
+		for f in files:
+			if f is not sys.stdin:
+				f.close()
+
+		if output is not sys.stdout:
+			output.close()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import botcmd
+import lexicon_cache
+import line_handling
+import linguistics
+import shared_lexicon
+
+# Microbenchmarks of the hot paths, run offline against the lexicon files in the current directory
+# Inputs are fixed so that runs can be compared with each other. Times are the best per-call time of several runs,
+# which is the least noisy number to compare
+
+sample_lines = [
+	b'PING :irc.example.net',
+	b':nick!user@host.example.net PRIVMSG #hymmnos :HynneFlip: gloss Was yea ra chs hymmnos mea',
+	b'@time=2024-01-01T00:00:00.000Z;msgid=abc :nick!user@host PRIVMSG #hymmnos :hello there',
+	b':irc.example.net 353 HynneFlip = #hymmnos :HynneFlip @op +voice someone someone_else',
+]
+
+sample_verbs = ['bAlduo', 'dOOdu', 'EXEC_hymme', 'rrha', 'wAs']
+
+sample_sentences = [
+	'Was yea ra chs hymmnos mea.',
+	'Rrha ki ra exec hymmnos /. nha Sarla, bAlduo!',
+	'Was quel ra sarla yor, ag rrha ar ciel enrer en chs hymmnos.',
+]
+
+sample_glosses = ['rrha', 'bAlduo', 'hymmnos', 'zzzz', 'Was']
+
+# Name of the handle_command branch → command line for it
+sample_commands = {
+	'hymmnos': 'hymmnos ale',
+	'pastalie': 'pastalie bAlduo',
+	'gloss': 'gloss ' + sample_sentences[1],
+	'english': 'english song of the world',
+	'english_substring': 'english nger',
+	'help': 'help english',
+	'unknown': 'frobnicate',
+}
+
+# bench(function) → seconds per call, calls per run
+# Run function enough times for a run to take around 0.2 seconds, and return the best of repeats runs
+def bench(function, repeats):
+	timer = timeit.Timer(function)
+	number, _ = timer.autorange()
+	return min(timer.repeat(repeat = repeats, number = number)) / number, number
+
+# bench_once(function, repeats) → seconds
+# For things too slow to run in a loop, like loading the lexicon. Best of repeats calls
+def bench_once(function, repeats):
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+
+	return min(times)
+
+# measure_memory(function) → peak bytes, retained bytes
+# Peak memory allocated while running function, and how much of it its result keeps allocated
+def measure_memory(function):
+	tracemalloc.start()
+	try:
+		result = function()
+		retained, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+
+	del result
+	return peak, retained
+
+def loop(function, inputs):
+	return lambda: [function(i) for i in inputs]
+
+# benchmarks(lexicon) → [(name, function, calls per function call)]
+def benchmarks(lexicon):
+	cases = [
+		('line_handling.parse_line', loop(line_handling.parse_line, sample_lines), len(sample_lines)),
+		('line_handling.peek_command', loop(line_handling.peek_command, sample_lines), len(sample_lines)),
+		('linguistics.parse_pastalie_verb', loop(linguistics.parse_pastalie_verb, sample_verbs), len(sample_verbs)),
+		('linguistics.parse_sentence', loop(linguistics.parse_sentence, sample_sentences), len(sample_sentences)),
+		# The gloss cache is warm after the first run, construct_gloss is the same work uncached
+		('botcmd.gloss_word', loop(lambda word: botcmd.gloss_word(lexicon, word), sample_glosses), len(sample_glosses)),
+		('botcmd.construct_gloss', loop(lambda word: botcmd.construct_gloss(lexicon, word), sample_glosses), len(sample_glosses)),
+	]
+
+	for branch, command in sample_commands.items():
+		cases.append(('botcmd.handle_command[%s]' % branch, lambda command = command: botcmd.handle_command(command), 1))
+
+	return cases
+
+# run(name_filter, repeats) → results
+def run(name_filter, repeats):
+	results = {'benchmarks': {}, 'lexicon': {}}
+
+	botcmd.initialize(config = None)
+	lexicon = botcmd.current_lexicon
+
+	for name, function, calls in benchmarks(lexicon):
+		if name_filter not in name:
+			continue
+
+		seconds, number = bench(function, repeats)
+		results['benchmarks'][name] = {'seconds_per_call': seconds / calls, 'calls': number * calls}
+
+	# The lexicon measurements are all named lexicon.something, and filtered by that full name
+	def wanted(*names):
+		return any(name_filter in 'lexicon.' + name for name in names)
+
+	path = botcmd.hymmnos_lexicon_path
+
+	if wanted('build_seconds'):
+		results['lexicon']['build_seconds'] = bench_once(lambda: botcmd.build_hymmnos_lexicon(path), repeats)
+
+	if wanted('emotions_seconds'):
+		results['lexicon']['emotions_seconds'] = bench_once(botcmd.read_emotion_lexicon, repeats)
+
+	# Load the compiled lexicon from a cache of our own, to not depend on the state of the real one
+	if wanted('cache_load_seconds', 'cache_load_peak_bytes', 'shared_attach_seconds', 'shared_attach_peak_bytes'):
+		with tempfile.TemporaryDirectory() as directory:
+			cache_path = os.path.join(directory, 'lexicon.cache')
+			lexicon_cache.store(cache_path, path, lexicon.hymmnos)
+			results['lexicon']['cache_load_seconds'] = bench_once(lambda: lexicon_cache.load(cache_path, path), repeats)
+
+			peak, retained = measure_memory(lambda: lexicon_cache.load(cache_path, path))
+			results['lexicon']['cache_load_peak_bytes'] = peak
+
+			# Attaching to the shared lexicon file only maps it, so it should take next to no time or memory
+			shared_path = os.path.join(directory, 'lexicon.shared')
+			shared_lexicon.store_hymmnos(shared_path, path, lexicon.hymmnos)
+			attach = lambda: shared_lexicon.attach_hymmnos(shared_path, path, botcmd.Entry, botcmd.HymmnosLexicon)
+			results['lexicon']['shared_attach_seconds'] = bench_once(attach, repeats)
+
+			peak, retained = measure_memory(attach)
+			results['lexicon']['shared_attach_peak_bytes'] = peak
+
+	if wanted('build_peak_bytes', 'retained_bytes'):
+		peak, retained = measure_memory(lambda: botcmd.build_hymmnos_lexicon(path))
+		results['lexicon']['build_peak_bytes'] = peak
+		results['lexicon']['retained_bytes'] = retained
+
+	# Some measurements are taken together, only keep the ones asked for
+	results['lexicon'] = {name: value for name, value in results['lexicon'].items() if wanted(name)}
+
+	results['python'] = platform.python_implementation() + ' ' + platform.python_version()
+	results['machine'] = platform.machine()
+
+	return results
+
+# compare(results, baseline, tolerance) → lines, regressions
+# Compare the times in results against baseline. Anything slower by more than tolerance (0.25 = 25 %) is a regression
+def compare(results, baseline, tolerance):
+	lines = []
+	regressions = []
+
+	measurements = [(name, result['seconds_per_call'], baseline['benchmarks'].get(name, {}).get('seconds_per_call')) for name, result in results['benchmarks'].items()]
+	measurements += [('lexicon.' + name, value, baseline['lexicon'].get(name)) for name, value in results['lexicon'].items()]
+
+	for name, value, baseline_value in measurements:
+		if baseline_value is None or baseline_value == 0:
+			lines.append('%-45s %14s' % (name, format_value(name, value)))
+			continue
+
+		change = value / baseline_value - 1
+		marker = ''
+		if change > tolerance:
+			marker = '  REGRESSION'
+			regressions.append(name)
+
+		lines.append('%-45s %14s %+8.1f %%%s' % (name, format_value(name, value), change * 100, marker))
+
+	return lines, regressions
+
+def format_value(name, value):
+	if name.endswith('_bytes'):
+		return '%.1f MiB' % (value / (1024 * 1024))
+
+	if value < 1e-3:
+		return '%.2f µs' % (value * 1e6)
+
+	return '%.2f ms' % (value * 1e3)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Benchmark the parsing, lookup, gloss and search hot paths')
+	parser.add_argument('--json', help = 'write the results as JSON to this file')
+	parser.add_argument('--baseline', help = 'compare against results saved earlier with --json')
+	parser.add_argument('--tolerance', type = float, default = 0.25, help = 'how much slower than the baseline counts as a regression (default 0.25, 25 %%)')
+	parser.add_argument('--filter', default = '', help = 'only run benchmarks with this in their name')
+	parser.add_argument('--repeats', type = int, default = 5, help = 'runs of each benchmark to take the best of')
+	arguments = parser.parse_args()
+
+	results = run(arguments.filter, arguments.repeats)
+
+	if arguments.baseline is not None:
+		with open(arguments.baseline, 'r') as f:
+			baseline = json.load(f)
+	else:
+		baseline = {'benchmarks': {}, 'lexicon': {}}
+
+	lines, regressions = compare(results, baseline, arguments.tolerance)
+	for line in lines:
+		print(line)
+
+	if arguments.json is not None:
+		with open(arguments.json, 'w') as f:
+			json.dump(results, f, indent = '\t', sort_keys = True)
+			f.write('\n')
+
+	if len(regressions) > 0:
+		print('%i regressions: %s' % (len(regressions), ', '.join(regressions)), file = sys.stderr)
+		sys.exit(1)
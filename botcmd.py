@@ -1,21 +1,86 @@
+import fnmatch
+import heapq
+import math
+import os
+import re
+import sys
 import threading
+import time
 import unicodedata
 from collections import namedtuple
 
+import lexicon_cache
 import linguistics
+import lrucache
+import metrics
+import offload
+import shared_lexicon
+import tracing
+
+hymmnos_lexicon_path = 'hymmnos-lexicon.text'
+hymmnos_lexicon_cache_path = 'hymmnos-lexicon.cache'
+emotion_lexicon_path = 'emotion-lexicon.text'
+hymmnos_lexicon_shared_path = 'hymmnos-lexicon.shared'
+emotion_lexicon_shared_path = 'emotion-lexicon.shared'
 
 Entry = namedtuple('Entry', ['hymmnos', 'word_class', 'pronunciation', 'meaning_ja', 'meaning_en', 'dialect'])
-hymmnos_lexicon = []
-hymmnos_lexicon_by_hymmnos = {}
-hymmnos_lexicon_lock = threading.Lock()
+# entries: list of Entry objects in the order of the lexicon file
+# by_hymmnos: normalized Hymmnos word → index of its entry
+# meanings: normalized meaning_en of each entry
+# trigrams: trigram of the normalized meanings → indices of the entries containing it
+# postings: word of the normalized meanings → postings of (index, frequency in meaning, frequency in notes)
+# field_lengths, average_field_lengths: lengths of the meaning and notes of the entries in words, for ranking
+HymmnosLexicon = namedtuple('HymmnosLexicon', ['entries', 'by_hymmnos', 'meanings', 'trigrams', 'postings', 'field_lengths', 'average_field_lengths'])
 
 Emotion = namedtuple('Emotion', ['hymmnos', 'meaning_en'])
-emotion_lexicon = {}
-emotion_lexicon_lock = threading.Lock()
+
+# A snapshot of everything read from the lexicon files. Snapshots are never modified after they have been built,
+# so readers don't need locks; reloading builds a new one and replaces current_lexicon with it
+# sources is the stat information of the files the snapshot was built from, used to detect changes
+# gloss_cache memoizes gloss_word for this snapshot, so that a reload starts with an empty one
+Lexicon = namedtuple('Lexicon', ['hymmnos', 'emotions', 'sources', 'gloss_cache'])
+current_lexicon = None
+
+# Sizes of the per-word caches. Pastalie decompositions don't depend on the lexicon, so that cache is kept over reloads
+gloss_cache_size = 4096
+pastalie_cache_size = 4096
+pastalie_cache = lrucache.LRUCache(pastalie_cache_size)
+
+# Whether to use the lexicon from memory mapped files shared by all processes using them, instead of a copy of our own
+shared = False
+
+# Only one reload should be running at a time
+reload_lock = threading.Lock()
+
+# nick!user@host patterns of the users allowed to use the stats command
+owners = []
+
+# Commands get their own label in the latency metrics, anything else is counted as 'other'
+metric_commands = {'hymmnos', 'pastalie', 'gloss', 'english', 'help', 'stats'}
+command_seconds = metrics.Histogram('hynneflip_command_seconds', 'Time taken to handle commands', ['command'])
+
+# How often (in seconds) to check whether the lexicon files have changed, and when that was last done
+check_interval = 10
+last_check = 0
+last_check_lock = threading.Lock()
+
+# Stat information of the lexicon files the last time reloading them failed
+failed_sources = None
 
 def initialize(*, config):
-	read_hymmnos_lexicon()
-	read_emotion_lexicon()
+	global check_interval, gloss_cache_size, pastalie_cache_size, pastalie_cache, shared, owners
+
+	if config is not None and 'lexicon' in config:
+		check_interval = config['lexicon'].getfloat('check_interval', check_interval)
+		gloss_cache_size = config['lexicon'].getint('gloss_cache_size', gloss_cache_size)
+		pastalie_cache_size = config['lexicon'].getint('pastalie_cache_size', pastalie_cache_size)
+		pastalie_cache = lrucache.LRUCache(pastalie_cache_size)
+		shared = config['lexicon'].getboolean('shared', shared)
+
+	if config is not None and 'bot' in config:
+		owners = config['bot'].get('owners', '').split()
+
+	reload_lexicon()
 
 def on_connect(*, irc):
 	pass
@@ -23,35 +88,275 @@ def on_connect(*, irc):
 def on_quit(*, irc):
 	pass
 
-def read_hymmnos_lexicon():
-	global hymmnos_lexicon, hymmnos_lexicon_by_hymmnos, hymmnos_lexicon_lock
+# reload_lexicon(irc = None) → lexicon
+# Read the lexicon files into a new snapshot and make it current. Lookups keep using the old snapshot until
+# it has been fully built. If the files can't be read, the error is logged through irc (or printed if None) and the
+# old snapshot is kept. Only when there is no old snapshot to keep, at startup, is the error raised
+def reload_lexicon(irc = None):
+	global current_lexicon, failed_sources
+
+	with reload_lock:
+		# Stat the files before reading them, so that changes during the reading get picked up by the next check
+		sources = stat_lexicon_files()
+
+		try:
+			lexicon = Lexicon(read_hymmnos_lexicon(), read_emotion_lexicon(), sources, lrucache.LRUCache(gloss_cache_size))
+
+		except Exception as err:
+			if current_lexicon is None:
+				raise
+
+			# Don't try again until the files change
+			failed_sources = sources
+
+			message = 'Error reloading the lexicon, keeping the old one: %s' % repr(err)
+			if irc is not None:
+				irc.error(message)
+			else:
+				print(message, file = sys.stderr)
+
+			return current_lexicon
+
+		# Replacing a reference is atomic, so readers see either the old or the new snapshot
+		current_lexicon = lexicon
+
+	return lexicon
+
+def stat_lexicon_files():
+	sources = []
+	for path in (hymmnos_lexicon_path, emotion_lexicon_path):
+		try:
+			stat = os.stat(path)
+			sources.append((path, stat.st_mtime_ns, stat.st_size))
+		except OSError:
+			sources.append((path, None, None))
 
-	with hymmnos_lexicon_lock:
-		# First read all entries into memory
-		with open('hymmnos-lexicon.text', 'r') as f:
-			for line in f:
-				hymmnos, word_class, pronunciation, meaning_ja, meaning_en, dialect = line.strip('\n').split('\t')
-				hymmnos_lexicon.append(Entry(hymmnos, word_class, pronunciation, meaning_ja, meaning_en, dialect))
+	return tuple(sources)
 
-		# Then build an index based on the Hymmnos word
-		for index, entry in enumerate(hymmnos_lexicon):
-			hymmnos_lexicon_by_hymmnos[normalize_casefold(entry.hymmnos)] = index
+# check_lexicon_files(irc = None)
+# Reload the lexicon in the background if its files have changed. Does the check at most once every
+# check_interval seconds, so it is cheap enough to call for every message. Errors are logged through irc
+def check_lexicon_files(irc = None):
+	global last_check
+
+	with last_check_lock:
+		now = time.monotonic()
+		if now - last_check < check_interval:
+			return
+		last_check = now
+
+	sources = stat_lexicon_files()
+	if sources != current_lexicon.sources and sources != failed_sources and not reload_lock.locked():
+		threading.Thread(target = reload_lexicon, args = (irc,), daemon = True).start()
+
+# cache_stats() → {name: stats}
+# Returns the hit and miss counts and sizes of the per-word caches, for the current lexicon
+def cache_stats():
+	return {'gloss': current_lexicon.gloss_cache.stats(), 'pastalie': pastalie_cache.stats()}
+
+def read_hymmnos_lexicon():
+	if shared:
+		# Attach to the shared lexicon file, building it first if it is missing or out of date
+		lexicon = shared_lexicon.attach_hymmnos(hymmnos_lexicon_shared_path, hymmnos_lexicon_path, Entry, HymmnosLexicon)
+		if lexicon is None:
+			lexicon = build_hymmnos_lexicon(hymmnos_lexicon_path)
+			shared_lexicon.store_hymmnos(hymmnos_lexicon_shared_path, hymmnos_lexicon_path, lexicon)
+
+			# Fall back to the lexicon we built if the file couldn't be written
+			lexicon = shared_lexicon.attach_hymmnos(hymmnos_lexicon_shared_path, hymmnos_lexicon_path, Entry, HymmnosLexicon) or lexicon
+
+		return lexicon
+
+	# Use the compiled lexicon if it is up to date with the text file, otherwise parse the text file and recompile
+	lexicon = lexicon_cache.load(hymmnos_lexicon_cache_path, hymmnos_lexicon_path)
+	if lexicon is None:
+		lexicon = build_hymmnos_lexicon(hymmnos_lexicon_path)
+		lexicon_cache.store(hymmnos_lexicon_cache_path, hymmnos_lexicon_path, lexicon)
+
+	return lexicon
+
+# build_hymmnos_lexicon(path) → lexicon
+# Parse the lexicon text file and build the indexes used for lookups
+def build_hymmnos_lexicon(path):
+	entries = []
+	by_hymmnos = {}
+	meanings = []
+	trigram_index = {}
+	postings = {}
+	field_lengths = []
+	average_field_lengths = (0, 0)
+
+	# First read all entries into memory
+	with open(path, 'r') as f:
+		for line in f:
+			hymmnos, word_class, pronunciation, meaning_ja, meaning_en, dialect = line.strip('\n').split('\t')
+			entries.append(Entry(hymmnos, word_class, pronunciation, meaning_ja, meaning_en, dialect))
+
+	# Then build an index based on the Hymmnos word
+	for index, entry in enumerate(entries):
+		by_hymmnos[normalize_casefold(entry.hymmnos)] = index
+
+	# Normalize the English meanings once, and build a trigram index over them for the english command
+	# Posting lists are kept in lexicon order, since entries are added in order
+	for index, entry in enumerate(entries):
+		meaning = normalize_casefold(entry.meaning_en)
+		meanings.append(meaning)
+
+		for trigram in trigrams(meaning):
+			trigram_index.setdefault(trigram, []).append(index)
+
+	# Build the inverted index over words, keeping the "(Note: …)" parts separate from the meaning itself
+	for index, meaning in enumerate(meanings):
+		meaning, notes = split_notes(meaning)
+		meaning_words = tokenize(meaning)
+		note_words = tokenize(notes)
+
+		for word in set(meaning_words) | set(note_words):
+			postings.setdefault(word, []).append((index, meaning_words.count(word), note_words.count(word)))
+
+		field_lengths.append((len(meaning_words), len(note_words)))
+
+	if len(field_lengths) > 0:
+		average_field_lengths = tuple(sum(lengths) / len(field_lengths) for lengths in zip(*field_lengths))
+
+	return HymmnosLexicon(entries, by_hymmnos, meanings, trigram_index, postings, field_lengths, average_field_lengths)
 
 def read_emotion_lexicon():
-	global emotion_lexicon, emotion_lexicon_lock
+	if shared:
+		emotion_lexicon = shared_lexicon.attach_emotions(emotion_lexicon_shared_path, emotion_lexicon_path, Emotion)
+		if emotion_lexicon is None:
+			emotion_lexicon = parse_emotion_lexicon()
+			shared_lexicon.store_emotions(emotion_lexicon_shared_path, emotion_lexicon_path, emotion_lexicon)
+			emotion_lexicon = shared_lexicon.attach_emotions(emotion_lexicon_shared_path, emotion_lexicon_path, Emotion) or emotion_lexicon
+
+		return emotion_lexicon
+
+	return parse_emotion_lexicon()
+
+def parse_emotion_lexicon():
+	emotion_lexicon = {}
 
-	with emotion_lexicon_lock:
-		with open('emotion-lexicon.text', 'r') as f:
-			for line in f:
-				hymmnos, meaning_en = line.strip('\n').split('\t')
-				emotion_lexicon[normalize_casefold(hymmnos)] = Emotion(hymmnos, meaning_en)
+	with open(emotion_lexicon_path, 'r') as f:
+		for line in f:
+			hymmnos, meaning_en = line.strip('\n').split('\t')
+			emotion_lexicon[normalize_casefold(hymmnos)] = Emotion(hymmnos, meaning_en)
+
+	return emotion_lexicon
 
 def normalize_casefold(text):
 	# Let's hope this is enough to avoid all corner cases…
 	return unicodedata.normalize('NFKD', text.casefold())
 
-def case_insensitive_search(needle, haystack):
-	return normalize_casefold(needle) in normalize_casefold(haystack)
+word_regex = re.compile(r'\w+')
+# Both "(Note:" and "(Notes:", in any case
+note_regex = re.compile(r'\(notes?:', re.IGNORECASE)
+
+def tokenize(text):
+	return word_regex.findall(text)
+
+# split_notes(meaning) → meaning, notes
+# Separate the "(Note: …)" parts of a meaning, which can contain parentheses of their own
+def split_notes(meaning):
+	rest = ''
+	notes = ''
+
+	index = 0
+	while True:
+		note_match = note_regex.search(meaning, index)
+		if note_match is None:
+			rest += meaning[index:]
+			break
+
+		note_start = note_match.start()
+		rest += meaning[index:note_start]
+
+		# Find the matching parenthesis, or take rest of the meaning if it's missing
+		depth = 0
+		note_end = len(meaning)
+		for i in range(note_start, len(meaning)):
+			if meaning[i] == '(':
+				depth += 1
+			elif meaning[i] == ')':
+				depth -= 1
+				if depth == 0:
+					note_end = i + 1
+					break
+
+		notes += meaning[note_start:note_end] + ' '
+		index = note_end
+
+	return rest, notes
+
+def trigrams(text):
+	return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# search_english(lexicon, needle) → indices
+# Yields indices of the entries whose English meaning contains needle, in lexicon order
+def search_english(lexicon, needle):
+	needle = normalize_casefold(needle)
+
+	if len(needle) < 3:
+		# Too short to have any trigrams, every entry is a candidate
+		candidates = range(len(lexicon.hymmnos.entries))
+
+	else:
+		# Any entry containing the needle contains all of its trigrams, so only entries that are in every
+		# posting list can match. Intersect starting from the shortest list to keep the sets small
+		posting_lists = sorted((lexicon.hymmnos.trigrams.get(trigram, ()) for trigram in trigrams(needle)), key = len)
+
+		candidates = set(posting_lists[0])
+		for posting_list in posting_lists[1:]:
+			if len(candidates) == 0:
+				break
+			candidates.intersection_update(posting_list)
+
+		candidates = sorted(candidates)
+
+	# Trigrams can match in a different order than in the needle, so verify the candidates
+	for index in candidates:
+		if needle in lexicon.hymmnos.meanings[index]:
+			yield index
+
+# How many results the english command lists at most
+english_max_results = 30
+
+# BM25 parameters, and how much a match in the notes counts compared to one in the meaning itself
+bm25_k1 = 1.2
+bm25_b = 0.75
+note_weight = 0.25
+
+# rank_english(lexicon, query, count) → indices
+# Returns indices of up to count entries best matching the words of query, best match first
+def rank_english(lexicon, query, count):
+	entries_count = len(lexicon.hymmnos.entries)
+	average_meaning_length, average_note_length = lexicon.hymmnos.average_field_lengths
+
+	def term_frequency(frequency, length, average_length):
+		if frequency == 0:
+			return 0
+		return frequency * (bm25_k1 + 1) / (frequency + bm25_k1 * (1 - bm25_b + bm25_b * length / average_length))
+
+	# Only score entries found in posting lists of the query's words
+	scores = {}
+	for word in set(tokenize(normalize_casefold(query))):
+		postings = lexicon.hymmnos.postings.get(word)
+		if postings is None:
+			continue
+
+		idf = math.log(1 + (entries_count - len(postings) + 0.5) / (len(postings) + 0.5))
+
+		for index, meaning_frequency, note_frequency in postings:
+			meaning_length, note_length = lexicon.hymmnos.field_lengths[index]
+
+			score = term_frequency(meaning_frequency, meaning_length, average_meaning_length)
+			score += note_weight * term_frequency(note_frequency, note_length, average_note_length)
+
+			scores[index] = scores.get(index, 0) + idf * score
+
+	# Pick the best ones using a heap of count entries. Ties are broken by the order in the lexicon
+	best = heapq.nlargest(count, scores.items(), key = lambda item: (item[1], -item[0]))
+
+	return [index for index, score in best]
 
 def construct_word_definition(entry):
 	# The format is (dialect) hymmnos /pronunciation/ - word-class meaning in English
@@ -75,7 +380,7 @@ def construct_word_definition(entry):
 
 	return response
 
-def define_emotions(emotions):
+def define_emotions(lexicon, emotions):
 	emotions_defined = set()
 	emotion_definitions = []
 
@@ -83,43 +388,63 @@ def define_emotions(emotions):
 		if emotion not in emotions_defined:
 			emotions_defined.add(emotion)
 
-			with emotion_lexicon_lock:
-				if normalize_casefold(emotion) in emotion_lexicon:
-					emotion_entry = emotion_lexicon[normalize_casefold(emotion)]
+			if normalize_casefold(emotion) in lexicon.emotions:
+				emotion_entry = lexicon.emotions[normalize_casefold(emotion)]
 
-					emotion_definitions.append('%s: %s' % (emotion_entry.hymmnos, emotion_entry.meaning_en))
+				emotion_definitions.append('%s: %s' % (emotion_entry.hymmnos, emotion_entry.meaning_en))
 
-				else:
-					emotion_definitions.append('(Unknown: %s)' % emotion)
+			else:
+				emotion_definitions.append('(Unknown: %s)' % emotion)
 
 		else:
 			emotion_definitions.append(emotion)
 
 	return emotion_definitions
 
-def gloss_word(hymmnos):
+# parse_pastalie_verb(word) → root, emotions
+# Memoized linguistics.parse_pastalie_verb. emotions is a tuple, since the result is shared between callers
+def parse_pastalie_verb(word):
+	result = pastalie_cache.get(word)
+
+	if result is None:
+		root, emotions = linguistics.parse_pastalie_verb(word)
+		result = (root, tuple(emotions))
+		pastalie_cache.put(word, result)
+
+	return result
+
+# gloss_word(lexicon, hymmnos) → gloss
+# Memoized construct_gloss. Keyed on the word as given, since Pastalie verbs are recognised by their case
+def gloss_word(lexicon, hymmnos):
+	gloss = lexicon.gloss_cache.get(hymmnos)
+
+	if gloss is None:
+		gloss = construct_gloss(lexicon, hymmnos)
+		lexicon.gloss_cache.put(hymmnos, gloss)
+
+	return gloss
+
+def construct_gloss(lexicon, hymmnos):
 		normal_word = False
 		pastalie_verb = False
 
 		# Check if the word is a pastalie verb
-		root, emotions = linguistics.parse_pastalie_verb(hymmnos)
+		root, emotions = parse_pastalie_verb(hymmnos)
 
 		if len(emotions) != 0:
-			with hymmnos_lexicon_lock:
-				if normalize_casefold(root) in hymmnos_lexicon_by_hymmnos:
-					# It is, mark it as such and put its definition into raw_definition
-					entry = hymmnos_lexicon[hymmnos_lexicon_by_hymmnos[normalize_casefold(root)]]
-					raw_definition = entry.meaning_en
-					pastalie_verb = True
+			if normalize_casefold(root) in lexicon.hymmnos.by_hymmnos:
+				# It is, mark it as such and put its definition into raw_definition
+				entry = lexicon.hymmnos.entries[lexicon.hymmnos.by_hymmnos[normalize_casefold(root)]]
+				raw_definition = entry.meaning_en
+				pastalie_verb = True
 
 		# If it's not a pastalie verb, check if it might be a normal word
 		if not pastalie_verb:
-			with hymmnos_lexicon_lock:
-				if normalize_casefold(hymmnos) in hymmnos_lexicon_by_hymmnos:
-					# It is, mark it as such and put its definition into raw_definition
-					entry = hymmnos_lexicon[hymmnos_lexicon_by_hymmnos[normalize_casefold(hymmnos)]]
-					raw_definition = entry.meaning_en
-					normal_word = True
+			if normalize_casefold(hymmnos) in lexicon.hymmnos.by_hymmnos:
+				# It is, mark it as such and put its definition into raw_definition
+				entry = lexicon.hymmnos.entries[lexicon.hymmnos.by_hymmnos[normalize_casefold(hymmnos)]]
+				raw_definition = entry.meaning_en
+				normal_word = True
 
 		if not normal_word and not pastalie_verb:
 			# We couldn't find this word, return '?'
@@ -140,7 +465,7 @@ def gloss_word(hymmnos):
 
 		if pastalie_verb:
 			# If we have a pastalie verb, define emotions and append them to the definition
-			emotion_definitions = define_emotions(emotions)
+			emotion_definitions = define_emotions(lexicon, emotions)
 
 			definition += ' <' + '; '.join(emotion_definitions) + '>'
 
@@ -150,20 +475,22 @@ def handle_command(command):
 	# Split the commands into the command itself and the argument. Remove additional whitespace around them
 	command, _, argument = (i.strip() for i in command.partition(' '))
 
+	# Use the same snapshot for the whole command, even if the lexicon is reloaded meanwhile
+	lexicon = current_lexicon
+
 	if command == 'hymmnos':
-		with hymmnos_lexicon_lock:
-			if normalize_casefold(argument) in hymmnos_lexicon_by_hymmnos:
-				entry = hymmnos_lexicon[hymmnos_lexicon_by_hymmnos[normalize_casefold(argument)]]
+		if normalize_casefold(argument) in lexicon.hymmnos.by_hymmnos:
+			entry = lexicon.hymmnos.entries[lexicon.hymmnos.by_hymmnos[normalize_casefold(argument)]]
 
-				return construct_word_definition(entry)
+			return construct_word_definition(entry)
 
-			else:
-				return 'Word not found "%s"' % argument
+		else:
+			return 'Word not found "%s"' % argument
 
 	elif command == 'pastalie':
-		root, emotions = linguistics.parse_pastalie_verb(argument)
+		root, emotions = parse_pastalie_verb(argument)
 
-		emotion_definitions = define_emotions(emotions)
+		emotion_definitions = define_emotions(lexicon, emotions)
 
 		return '%s <%s>' % (root, '; '.join(emotion_definitions))
 
@@ -173,7 +500,7 @@ def handle_command(command):
 		gloss_text = ''
 		for is_word, text in sentence_parts:
 			if is_word:
-				gloss_text += '[%s]' % gloss_word(text)
+				gloss_text += '[%s]' % gloss_word(lexicon, text)
 
 			else:
 				gloss_text += text
@@ -181,31 +508,34 @@ def handle_command(command):
 		return gloss_text
 
 	elif command == 'english':
-		bytes_length = 0
-		matches = []
-		with hymmnos_lexicon_lock:
-			for entry in hymmnos_lexicon:
-				if case_insensitive_search(argument, entry.meaning_en):
-					matches.append(entry.hymmnos)
+		# Ask for one more than we list, to know whether to signal there are more
+		indices = rank_english(lexicon, argument, english_max_results + 1)
+
+		if len(indices) == 0:
+			# None of the words matched, fall back to looking for the text inside the meanings
+			indices = search_english(lexicon, argument)
 
-					# Try to estimate how long the response will be, and cut off searching once we run into the limit of 350
-					# (Assuming 160 bytes is enough for prefix, command, channel name, etc.)
-					# Adding 2 bytes for the ', ' between the entries
-					bytes_length += len(entry.hymmnos.encode('utf-8')) + 2
-					if bytes_length > 350:
-						# Remove the one that put us over 350 bytes
-						matches.pop()
+		matches = []
+		listed = set()
+		for index in indices:
+			entry = lexicon.hymmnos.entries[index]
 
-						# Have a '…' follow the matches to signal some are missing
-						matches.append('…')
+			# Entries for different dialects can share the word, only list it once
+			if entry.hymmnos in listed:
+				continue
 
-						# Break out of the loop
+			if len(matches) == english_max_results:
+				# Have a '…' follow the matches to signal some are missing
+				matches.append('…')
+				break
 
-						break
+			matches.append(entry.hymmnos)
+			listed.add(entry.hymmnos)
 
 		if len(matches) == 0:
 			return 'No matches'
 
+		# Long responses are split into several lines when sending
 		return ', '.join(matches)
 
 	elif command == 'help':
@@ -216,7 +546,7 @@ def handle_command(command):
 		elif argument == 'gloss':
 			return "gloss <sentence> – Try to gloss a sentence. '.' is always considered part of a word."
 		elif argument == 'english':
-			return "english <text> – Look for a word in Hymmnos (substring search of the 'Meaning (E)' field)"
+			return "english <text> – Look for a word in Hymmnos (best matches for the words of the 'Meaning (E)' field, or substring search if no word matches)"
 		elif argument == 'help':
 			return "help [<command>] – See list of commands or description for a command"
 		else:
@@ -225,15 +555,16 @@ def handle_command(command):
 	else:
 		return 'Command not recognised: %s' % command
 
-# handle_message(*, prefix, message, nick, channel, irc)
+# handle_message(*, tags, prefix, message, nick, channel, irc)
 # Called for PRIVMSGs.
+# tags are the IRCv3 message tags of the line, as a read-only mapping of name to value
 # prefix is the prefix at the start of the message, without the leading ':'
 # message is the contents of the message
 # nick is who sent the message
 # channel is where you should send the response (note: in queries nick == channel)
 # irc is the IRC API object
 # All strings are bytestrings or bytearrays
-def handle_message(*, prefix, message, nick, channel, irc):
+def handle_message(*, tags, prefix, message, nick, channel, irc):
 	own_nick = irc.get_nick()
 
 	# Run a command if it's prefixed with our nick we're in a query
@@ -247,9 +578,53 @@ def handle_message(*, prefix, message, nick, channel, irc):
 			response_prefix = b''
 
 		command = command.decode(encoding = 'utf-8', errors = 'replace')
-		response = '\u200b' + handle_command(command)
 
-		irc.msg(channel, response_prefix + response.encode('utf-8'))
+		# Pick up changes to the lexicon files
+		check_lexicon_files(irc)
+		tracing.mark('lexicon check')
+
+		start = time.perf_counter()
+
+		# Metrics can tell a lot about the channels the bot is on, so only show them to the owners
+		name, _, argument = (i.strip() for i in command.partition(' '))
+		if name == 'stats' and is_owner(prefix):
+			response = metrics.summary(argument)
+		elif offload.offloaded(name):
+			try:
+				response = offload.run(name, command)
+			except offload.Timeout:
+				response = 'Command took too long'
+			except offload.WorkerError as err:
+				irc.error('Offloaded command %s failed: %s' % (command, err))
+				response = 'Command failed'
+			except offload.Cancelled:
+				# The bot is quitting
+				return
+		else:
+			response = handle_command(command)
+
+		command_seconds.observe(time.perf_counter() - start, name if name in metric_commands else 'other')
+		tracing.mark('command')
+
+		# Each line of a response that doesn't fit on one line gets the prefix
+		irc.msg(channel, response.encode('utf-8'), line_prefix = response_prefix + '\u200b'.encode('utf-8'))
 
-def handle_nonmessage(*, prefix, command, arguments, irc):
+# is_owner(prefix) → owner
+# Whether the sender with the nick!user@host prefix matches one of the owner patterns
+def is_owner(prefix):
+	if prefix is None:
+		return False
+
+	prefix = prefix.decode(encoding = 'utf-8', errors = 'replace').lower()
+	return any(fnmatch.fnmatchcase(prefix, owner.lower()) for owner in owners)
+
+# Upper case commands other than PRIVMSG that handle_nonmessage wants to see
+# Lines with other commands are dropped before they are queued for handling
+nonmessage_commands = set()
+
+# handle_nonmessage(*, tags, prefix, command, arguments, irc)
+# Called for lines with a command in nonmessage_commands
+# tags are the IRCv3 message tags of the line, as in handle_message
+# All strings are bytestrings or bytearrays
+def handle_nonmessage(*, tags, prefix, command, arguments, irc):
 	pass
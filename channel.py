@@ -1,3 +1,4 @@
+import collections
 import select
 import socket
 import threading
@@ -11,17 +12,30 @@ class Channel:
 		self.poll = select.poll()
 		self.poll.register(self.read_socket, select.POLLIN)
 
-		# Store messages in a list
-		self.mesages = []
+		# Store messages in a deque
+		self.messages = collections.deque()
 		self.messages_lock = threading.Lock()
 
 	def send(self, message):
-		# Add message to the list of messages and write to the write socket to signal there's data to read
+		# Add message to the queue of messages. The socket has one byte to read whenever there are messages,
+		# so we only need to write to it when the queue was empty
 		with self.messages_lock:
-			self.write_socket.sendall(b'!')
-			self.mesages.append(message)
+			self.messages.append(message)
+
+			if len(self.messages) == 1:
+				self.write_socket.sendall(b'!')
 
 	def recv(self, blocking = True):
+		"""Returns the next message, or None if not blocking and there are none."""
+		messages = self.recv_many(1, blocking = blocking)
+
+		if len(messages) == 0:
+			return None
+
+		return messages[0]
+
+	def recv_many(self, max_count = None, blocking = True):
+		"""Returns a list of up to max_count messages (all available if None), waiting for at least one if blocking."""
 		# Timeout of -1 will make poll wait until data is available
 		# Timeout of 0 will make poll exit immediately if there's no data
 		if blocking:
@@ -29,22 +43,36 @@ class Channel:
 		else:
 			timeout = 0
 
-		# See if there is data to read / wait until there is
-		results = self.poll.poll(timeout)
+		while True:
+			# See if there is data to read / wait until there is
+			results = self.poll.poll(timeout)
 
-		# None of the sockets were ready. This can only happen if we weren't blocking
-		# Return None to signal lack of data
-		if len(results) == 0:
-			assert not blocking
-			return None
+			# None of the sockets were ready. This can only happen if we weren't blocking
+			# Return an empty list to signal lack of data
+			if len(results) == 0:
+				assert not blocking
+				return []
 
-		# Remove first message from the list (FIFO principle), and read one byte from the socket
-		# This keeps the number of available messages and the number of bytes readable in the socket in sync
-		with self.messages_lock:
-			message = self.mesages.pop(0)
-			self.read_socket.recv(1)
+			# Remove messages from the start of the queue (FIFO principle). If that empties the queue, read the
+			# byte from the socket, keeping it readable exactly when there are messages
+			with self.messages_lock:
+				if max_count is None or max_count >= len(self.messages):
+					messages = list(self.messages)
+					self.messages.clear()
+				else:
+					messages = [self.messages.popleft() for _ in range(max_count)]
+
+				if len(messages) > 0 and len(self.messages) == 0:
+					self.read_socket.recv(1)
 
-		return message
+			# Another reader can have taken the messages between poll and taking the lock
+			if len(messages) > 0 or not blocking:
+				return messages
+
+	def qsize(self):
+		"""Returns the number of messages waiting to be received."""
+		with self.messages_lock:
+			return len(self.messages)
 
 	def fileno(self):
 		# Allows for a Channel object to be passed directly to poll()
@@ -1,13 +1,19 @@
 import enum
 
 class logmessage_types(enum.Enum):
-	sent, received, internal = range(3)
+	sent, received, internal, network = range(4)
+
+class loglevel_types(enum.Enum):
+	traffic, info, error = range(3)
 
 class internal_submessage_types(enum.Enum):
-	quit, error = range(2)
+	quit, error, slow = range(3)
 
 class controlmessage_types(enum.Enum):
 	quit, reconnect, send_line, ping, ping_timeout = range(5)
 
 class cronmessage_types(enum.Enum):
-	quit, schedule, delete, reschedule = range(4)
+	quit, schedule, delete, reschedule, cancel, rearm = range(6)
+
+class sendpriority_types(enum.Enum):
+	urgent, normal = range(2)
@@ -1,3 +1,5 @@
+import heapq
+import itertools
 import select
 import threading
 import time
@@ -7,26 +9,94 @@ import channel
 from constants import cronmessage_types
 
 # time field uses the monotonic time returned by time.monotonic()
-Event = namedtuple('Event', ['time', 'channel', 'message'])
+# timer is the Timer handle of the event, if it has one
+# period makes the event recurring: it is run again every period seconds
+# activity makes the event an idle timer: it is run once activity has been idle for period seconds, and
+# again every period seconds for as long as activity stays idle
+Event = namedtuple('Event', ['time', 'channel', 'message', 'timer', 'period', 'activity'], defaults = (None, None, None))
+
+class Activity:
+	"""Last activity time for idle timers. touch() doesn't talk to cron, idle timers check it when they come up."""
+
+	def __init__(self):
+		self.last = time.monotonic()
+
+	def touch(self):
+		self.last = time.monotonic()
+
+class Timer:
+	"""Handle to a scheduled event, returned by schedule(), schedule_periodic() and schedule_idle()."""
+
+	def __init__(self, cron_control_channel):
+		self.cron_control_channel = cron_control_channel
+		self.event = None
+
+	def cancel(self):
+		"""Remove the event. If it has already been run (and isn't recurring), this is a no-op"""
+		self.cron_control_channel.send((cronmessage_types.cancel, self))
+
+	def rearm(self, seconds):
+		"""Run the event in seconds instead of when it was scheduled. Schedules it again if it has already been run"""
+		self.cron_control_channel.send((cronmessage_types.rearm, self, time.monotonic() + seconds))
+
+# next_occurrence(event, current_time) → run, next_event
+# Decide whether an event that has come up should be run, and what should come up next (None if nothing)
+def next_occurrence(event, current_time):
+	if event.activity is not None:
+		# Idle timer. Only run it if there has been no activity since it was scheduled, otherwise
+		# check again when the activity would have been idle long enough
+		idle_until = event.activity.last + event.period
+		if idle_until > current_time:
+			return False, event._replace(time = idle_until)
+
+		return True, event._replace(time = current_time + event.period)
+
+	elif event.period is not None:
+		# Recurring event. If we've fallen behind, skip the runs we missed
+		next_time = event.time + event.period
+		if next_time <= current_time:
+			next_time = current_time + event.period
+
+		return True, event._replace(time = next_time)
+
+	else:
+		return True, None
 
 class CronThread(threading.Thread):
 	def __init__(self, cron_control_channel):
 		self.cron_control_channel = cron_control_channel
 
-		# Sorted array of events
+		# Heap of [time, sequence number, event] entries. Deleted events are left in the heap with their event
+		# set to None, and skipped when they come up. The sequence number keeps events with the same time in the
+		# order they were added
 		self.events = []
+		self.sequence = itertools.count()
+		self.deleted_count = 0
+
+		# (channel, message) → list of the entries of the events with that channel and message
+		self.events_by_key = {}
+		# Timer → entry of its event
+		self.events_by_timer = {}
 
 		threading.Thread.__init__(self)
 
+	def remove_deleted(self):
+		# Pop deleted entries from the top of the heap, so that the first entry is a live one
+		while len(self.events) > 0 and self.events[0][2] is None:
+			heapq.heappop(self.events)
+			self.deleted_count -= 1
+
 	def get_timeout_value(self):
+		self.remove_deleted()
+
 		if len(self.events) == 0:
 			# No events, block until we get a message
 			# Timeout of -1 makes poll block indefinitely
 			return -1
 
 		else:
-			# First event in the array is always the earliest
-			seconds_to_wait = self.events[0].time - time.monotonic()
+			# First event in the heap is always the earliest
+			seconds_to_wait = self.events[0][0] - time.monotonic()
 
 			# time.monotonic() uses fractional second but poll uses milliseconds, convert
 			ms_to_wait = int(seconds_to_wait * 1000)
@@ -38,55 +108,91 @@ class CronThread(threading.Thread):
 			return ms_to_wait
 
 	def run_events(self):
-		assert len(self.events) > 0
-
 		current_time = time.monotonic()
 
-		# Look for first event that should be run after current time, and split the array there
-		# index should point at the first to be after current time, or at end of array
-		# Either way, we can split the array at that location, first part being what to run and second rest
-		index = 0
-		while index < len(self.events):
-			if self.events[index].time > current_time:
-				break
-			index += 1
+		# Pop every event that should have been run by now
+		to_run = []
+		while len(self.events) > 0 and self.events[0][0] <= current_time:
+			entry = heapq.heappop(self.events)
+			event = entry[2]
+
+			if event is None:
+				self.deleted_count -= 1
+				continue
+
+			self.forget_entry(entry)
+
+			run, next_event = next_occurrence(event, current_time)
+
+			if next_event is not None:
+				self.add_event(next_event)
 
-		# Split array
-		to_run = self.events[:index]
-		self.events = self.events[index:]
+			if run:
+				to_run.append(event)
 
 		# Run events
 		for event in to_run:
 			event.channel.send(event.message)
 
 	def add_event(self, event):
-		# Look for first event that should be run after event, and split the array there
-		# index should point at the first to be after event, or at end of array
-		# Either way, we can split the array at that location safely
-		index = 0
-		while index < len(self.events):
-			if self.events[index].time > event.time:
-				break
-			index += 1
+		entry = [event.time, next(self.sequence), event]
+		heapq.heappush(self.events, entry)
+		self.events_by_key.setdefault((event.channel, event.message), []).append(entry)
 
-		self.events = self.events[:index] + [event] + self.events[index:]
+		if event.timer is not None:
+			self.events_by_timer[event.timer] = entry
+
+	def forget_entry(self, entry):
+		event = entry[2]
+
+		key = (event.channel, event.message)
+		entries = self.events_by_key[key]
+
+		entries.remove(entry)
+		if len(entries) == 0:
+			del self.events_by_key[key]
+
+		if event.timer is not None:
+			del self.events_by_timer[event.timer]
+
+	def delete_entry(self, entry):
+		self.forget_entry(entry)
+
+		# Mark it as deleted, to be removed from the heap when it comes up
+		entry[2] = None
+		self.deleted_count += 1
+
+		# Don't let deleted events take over the heap if they are far in the future
+		if self.deleted_count > 64 and self.deleted_count > len(self.events) // 2:
+			self.events = [entry for entry in self.events if entry[2] is not None]
+			heapq.heapify(self.events)
+			self.deleted_count = 0
 
 	def delete_event(self, event):
-		# Try to find the element with same channel and message
-		index = 0
-		while index < len(self.events):
-			if self.events[index].channel == event.channel and self.events[index].message == event.message:
-				break
-			index += 1
+		# Find the earliest event with same channel and message
+		entries = self.events_by_key.get((event.channel, event.message))
+		if entries is None:
+			return
 
-		if index < len(self.events):
-			# The event at index is the one we need to delete
-			self.events = self.events[:index] + self.events[index + 1:]
+		self.delete_entry(min(entries))
 
 	def reschedule_event(self, event):
 		self.delete_event(event)
 		self.add_event(event)
 
+	def cancel_timer(self, timer):
+		entry = self.events_by_timer.get(timer)
+		if entry is not None:
+			self.delete_entry(entry)
+
+	def rearm_timer(self, timer, new_time):
+		self.cancel_timer(timer)
+		self.add_event(timer.event._replace(time = new_time))
+
+	def queue_size(self):
+		"""Number of events waiting to be run"""
+		return len(self.events) - self.deleted_count
+
 	def run(self):
 		# Create poll object and register the control channel
 		# The poll object is used to implement both waiting and control of the cron thread
@@ -120,31 +226,75 @@ class CronThread(threading.Thread):
 					event, = arguments
 					self.reschedule_event(event)
 
+				elif command_type == cronmessage_types.cancel:
+					timer, = arguments
+					self.cancel_timer(timer)
+
+				elif command_type == cronmessage_types.rearm:
+					timer, new_time = arguments
+					self.rearm_timer(timer, new_time)
+
 				else:
 					assert False #unreachable
 
+# Control channel → its CronThread, for queue_size()
+cron_threads = {}
+
 def start():
 	cron_control_channel = channel.Channel()
-	CronThread(cron_control_channel).start()
+	cron_threads[cron_control_channel] = CronThread(cron_control_channel)
+	cron_threads[cron_control_channel].start()
 	return cron_control_channel
 
+def queue_size(cron_control_channel):
+	"""Number of events waiting to be run by the cron instance"""
+	if cron_control_channel in cron_threads:
+		return cron_threads[cron_control_channel].queue_size()
+
+	# Stand-ins for the cron thread keep track of it themselves
+	return cron_control_channel.queue_size()
+
 def quit(cron_control_channel):
 	"""Stop the cron instance"""
 	cron_control_channel.send((cronmessage_types.quit,))
 
+# check_key(channel, message)
+# Events are looked up by their channel and message, so both have to be hashable. Raises TypeError here in the caller
+# if they aren't, rather than in the cron thread, which would die of it
+def check_key(channel, message):
+	hash((channel, message))
+
+def schedule_event(cron_control_channel, seconds, channel, message, *, period = None, activity = None):
+	check_key(channel, message)
+
+	timer = Timer(cron_control_channel)
+	timer.event = Event(time.monotonic() + seconds, channel, message, timer, period, activity)
+	cron_control_channel.send((cronmessage_types.schedule, timer.event))
+	return timer
+
 def schedule(cron_control_channel, seconds, channel, message):
-	"""Schedules message to be send to channel"""
-	event = Event(time.monotonic() + seconds, channel, message)
-	cron_control_channel.send((cronmessage_types.schedule, event))
+	"""Schedules message to be send to channel. Returns a Timer for the event"""
+	return schedule_event(cron_control_channel, seconds, channel, message)
+
+def schedule_periodic(cron_control_channel, seconds, channel, message):
+	"""Schedules message to be send to channel every seconds, until cancelled. Returns a Timer for the event"""
+	return schedule_event(cron_control_channel, seconds, channel, message, period = seconds)
+
+def schedule_idle(cron_control_channel, activity, seconds, channel, message):
+	"""Schedules message to be send to channel whenever activity has been idle for seconds, until cancelled.
+	Returns a Timer for the event"""
+	return schedule_event(cron_control_channel, seconds, channel, message, period = seconds, activity = activity)
 
 def delete(cron_control_channel, channel, message):
 	"""Remove an event. If event is not found, this is a no-op.
 	Matches events based on channel and message, and only applies to the earlier one found."""
+	check_key(channel, message)
 	event = Event(None, channel, message)
 	cron_control_channel.send((cronmessage_types.delete, event))
 
 def reschedule(cron_control_channel, seconds, channel, message):
 	"""Reschedules message to be send to channel. If event is not found, a new one is created.
 	Matches events based on channel and message, and only applies to the earlier one found."""
+	check_key(channel, message)
 	event = Event(time.monotonic() + seconds, channel, message)
 	cron_control_channel.send((cronmessage_types.reschedule, event))
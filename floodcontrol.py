@@ -0,0 +1,138 @@
+import collections
+import threading
+import time
+
+import metrics
+from constants import sendpriority_types
+
+send_wait = metrics.Histogram('hynneflip_send_wait_seconds', 'Time lines spend queued for flood control before being sent', ['priority'])
+
+class TokenBucket:
+	"""Allows burst lines at once, and rate lines per second after that. Not thread-safe by itself."""
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+
+		self.tokens = burst
+		self.last_refill = time.monotonic()
+
+		# Tokens given with add(), kept apart so that they never take the bucket over the burst size
+		self.extra = 0
+
+	def refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+		self.last_refill = now
+
+	def take(self, extra = False):
+		"""Take a token if there is one and return 0, otherwise return how many seconds until there is one
+		If extra, the extra tokens are used first. Otherwise they are thrown away, since what they were for is over"""
+		now = time.monotonic()
+		self.refill(now)
+
+		if extra and self.extra > 0:
+			self.extra -= 1
+			return 0
+
+		if not extra:
+			self.extra = 0
+
+		if self.tokens >= 1:
+			self.tokens -= 1
+			return 0
+
+		return (1 - self.tokens) / self.rate
+
+	def add(self, count):
+		"""Give count extra tokens, for take(extra = True)"""
+		self.extra += count
+
+# priority_of(line) → priority
+# PINGs, PONGs and QUITs skip the queue and flood control, everything else waits its turn
+def priority_of(line):
+	command = line.split(b' ', 1)[0].upper()
+	if command in (b'PING', b'PONG', b'QUIT'):
+		return sendpriority_types.urgent
+
+	return sendpriority_types.normal
+
+# is_registration(line) → registration
+# Whether the line is part of registering with the server and joining channels, which can use the extra tokens
+def is_registration(line):
+	command = line.split(b' ', 1)[0].upper()
+	return command in (b'PASS', b'CAP', b'NICK', b'USER', b'JOIN')
+
+class OutboundQueue:
+	"""Lines waiting to be sent to a server. get() hands out urgent lines right away, and normal lines as the
+	token bucket allows."""
+
+	def __init__(self, rate, burst):
+		self.bucket = TokenBucket(rate, burst)
+
+		self.lines = {sendpriority_types.urgent: collections.deque(), sendpriority_types.normal: collections.deque()}
+		self.condition = threading.Condition()
+		self.closed = False
+
+	def put(self, item, priority, registration = False):
+		"""Queue item. registration items can use the tokens given with allow_burst. Returns False if closed"""
+		with self.condition:
+			if self.closed:
+				return False
+
+			self.lines[priority].append((item, time.monotonic(), registration))
+			self.condition.notify()
+
+			return True
+
+	def get(self):
+		"""Returns the next item to send, blocking until there is one. Returns None once the queue is closed and has
+		no urgent items left. Normal items left in a closed queue are dropped"""
+		with self.condition:
+			while True:
+				if len(self.lines[sendpriority_types.urgent]) > 0:
+					return self.take(sendpriority_types.urgent)
+
+				if self.closed:
+					return None
+
+				if len(self.lines[sendpriority_types.normal]) > 0:
+					_, _, registration = self.lines[sendpriority_types.normal][0]
+					wait = self.bucket.take(registration)
+					if wait == 0:
+						return self.take(sendpriority_types.normal)
+
+					# Wake up when there is a token, or earlier if an urgent line comes in
+					self.condition.wait(wait)
+
+				else:
+					self.condition.wait()
+
+	def take(self, priority):
+		item, queued, _ = self.lines[priority].popleft()
+		send_wait.observe(time.monotonic() - queued, priority.name)
+		return item
+
+	def allow_burst(self, count):
+		"""Let count more registration lines through right away after connecting. The allowance ends once some
+		other normal line is sent"""
+		with self.condition:
+			self.bucket.add(count)
+			self.condition.notify()
+
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify()
+
+	def drop_all(self):
+		"""Remove and return the items left in the queue, which won't be sent. For once the writer has stopped"""
+		with self.condition:
+			items = [item for priority in self.lines for item, _, _ in self.lines[priority]]
+			for lines in self.lines.values():
+				lines.clear()
+
+			return items
+
+	def qsize(self):
+		with self.condition:
+			return sum(len(lines) for lines in self.lines.values())
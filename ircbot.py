@@ -2,19 +2,123 @@
 import configparser
 import select
 import socket
+import sys
 import threading
 import time
 from collections import namedtuple
 
 import channel
+import floodcontrol
+import logger
+import metrics
+import tracing
 from constants import logmessage_types, internal_submessage_types, controlmessage_types
 
 import botcmd
 import cron
 import line_handling
+import offload
 
-Server = namedtuple('Server', ['host', 'port', 'nick', 'username', 'realname', 'channels'])
+# read_size is how many bytes to read from the server socket at once
+# flood_rate and flood_burst are the lines per second and lines at once we can send without the server minding
+# max_reply_lines is how many lines a message sent with API.msg can be split into
+# name is what the network is called in the log and on the console, None if it's the only one
+# channel_keys maps the channels that need a key to join to their keys, None if none do
+# register_burst is how many lines on top of flood_burst we can send right after connecting
+Server = namedtuple('Server', ['host', 'port', 'nick', 'username', 'realname', 'channels', 'read_size', 'flood_rate', 'flood_burst', 'max_reply_lines', 'name', 'channel_keys', 'register_burst'], defaults = (16384, 1.0, 4, 3, None, None, 8))
 
+NetworkStats = namedtuple('NetworkStats', ['connected', 'lines_received', 'lines_sent', 'send_queue', 'dropped_lines'])
+
+class ReceiveBuffer:
+	"""Buffer that is read into from a socket and split into lines ending with \\r\\n without copying the rest."""
+
+	def __init__(self, size, max_size):
+		self.buffer = bytearray(size)
+		self.view = memoryview(self.buffer)
+
+		# Most the buffer can grow to hold a single unfinished line
+		self.max_size = max_size
+
+		# Data that hasn't been split into lines yet is at buffer[start:end]
+		# Everything in buffer[start:scanned] has already been checked not to contain the end of a line
+		self.start = 0
+		self.end = 0
+		self.scanned = 0
+
+		self.discarded_bytes = 0
+
+		# Set when the start of a line has been thrown away, until the rest of it has been skipped too
+		self.discarding = False
+
+	def make_room(self, size):
+		if len(self.buffer) - self.end >= size:
+			return
+
+		# Move the unfinished line to the start of the buffer
+		pending = self.end - self.start
+		self.view[:pending] = self.view[self.start:self.end]
+		self.scanned -= self.start
+		self.start = 0
+		self.end = pending
+
+		if len(self.buffer) - self.end >= size:
+			return
+
+		if pending + size > self.max_size:
+			# Nobody sends lines this long, throw the unfinished one away, and the rest of it once it comes
+			self.discarded_bytes += pending
+			self.start = self.end = self.scanned = 0
+			self.discarding = True
+			return
+
+		# Grow the buffer. The view has to be released to be allowed to resize it
+		self.view.release()
+		self.buffer.extend(bytes(pending + size - len(self.buffer)))
+		self.view = memoryview(self.buffer)
+
+	def recv_from(self, sock, size):
+		"""Read up to size bytes from sock into the buffer. Returns the number of bytes read."""
+		self.make_room(size)
+
+		count = sock.recv_into(self.view[self.end:], size)
+		self.end += count
+
+		return count
+
+	def lines(self):
+		"""Yield all complete lines in the buffer (without the \\r\\n) and remove them from it."""
+		while True:
+			# The \r of a \r\n can be the last byte checked last time, so step back by one
+			index = self.buffer.find(b'\r\n', max(self.start, self.scanned - 1), self.end)
+
+			if index == -1:
+				if self.discarding:
+					# Keep a \r at the end, since it can be the start of the \r\n ending the line
+					keep = 1 if self.end > self.start and self.buffer[self.end - 1] == ord('\r') else 0
+					self.discarded_bytes += self.end - keep - self.start
+					self.start = self.end - keep
+
+				self.scanned = self.end
+				break
+
+			if self.discarding:
+				# The end of the line whose start was thrown away, skip it
+				self.discarded_bytes += index + 2 - self.start
+				self.start = self.scanned = index + 2
+				self.discarding = False
+				continue
+
+			line = bytes(self.view[self.start:index])
+			self.start = self.scanned = index + 2
+
+			yield line
+
+		# Everything has been handled, start filling the buffer from the beginning again
+		if self.start == self.end:
+			self.start = self.end = self.scanned = 0
+
+# LoggerThread(logging_channel, dead_notify_channel)
+# Writes the messages from logging_channel, a logger.LogQueue, to the log in batches
 class LoggerThread(threading.Thread):
 	def __init__(self, logging_channel, dead_notify_channel):
 		self.logging_channel = logging_channel
@@ -23,36 +127,41 @@ class LoggerThread(threading.Thread):
 		threading.Thread.__init__(self)
 
 	def run(self):
-		while True:
-			message_type, *message_data = self.logging_channel.recv()
+		output = logger.open_output()
 
-			# Lines that were sent between server and client
-			if message_type == logmessage_types.sent:
-				assert len(message_data) == 1
-				print('>' + message_data[0])
+		quitting = False
+		while not quitting:
+			# Write everything that has queued up at once
+			messages = self.logging_channel.recv_many()
+
+			for index, message in enumerate(messages):
+				if logger.is_quit(message):
+					messages = messages[:index + 1]
+					quitting = True
+					break
 
-			elif message_type == logmessage_types.received:
-				assert len(message_data) == 1
-				print('<' + message_data[0])
+			logger.write_messages(output, messages, self.logging_channel.take_dropped())
 
-			# Messages that are from internal components
-			elif message_type == logmessage_types.internal:
-				if message_data[0] == internal_submessage_types.quit:
-					assert len(message_data) == 1
-					print('--- Quit')
+		output.close()
+		self.dead_notify_channel.send((controlmessage_types.quit,))
 
-					self.dead_notify_channel.send((controlmessage_types.quit,))
-					break
+# NetworkLog(logging_channel, name)
+# Passes log messages on to logging_channel, marked with the name of the network they are about
+class NetworkLog:
+	def __init__(self, logging_channel, name):
+		self.logging_channel = logging_channel
+		self.name = name
 
-				elif message_data[0] == internal_submessage_types.error:
-					assert len(message_data) == 2
-					print('--- Error', message_data[1])
+	def send(self, message):
+		self.logging_channel.send((logmessage_types.network, self.name, message))
 
-				else:
-					print('--- ???', message_data)
+# network_log(logging_channel, server) → logging_channel
+# Returns a channel to log about server into. Only marks the messages with the network name if it has one
+def network_log(logging_channel, server):
+	if server.name is None:
+		return logging_channel
 
-			else:
-				print('???', message_type, message_data)
+	return NetworkLog(logging_channel, server.name)
 
 # API(serverthread_object)
 # Create a new API object corresponding to given ServerThread object
@@ -69,17 +178,22 @@ class API:
 		Don't use unless you are completely sure you know what you're doing."""
 		self.serverthread_object.send_line_raw(line)
 
-	def msg(self, recipient, message):
-		"""Make sending PRIVMSGs much nicer"""
-		line = b'PRIVMSG ' + recipient + b' :' + message
-		self.serverthread_object.send_line_raw(line)
+	def msg(self, recipient, message, line_prefix = b''):
+		"""Make sending PRIVMSGs much nicer
+		Messages too long for one line are split into several, each starting with line_prefix."""
+		# The server relays the message as ':nick!user@host PRIVMSG recipient :message\r\n', in at most 512 bytes
+		command = b'PRIVMSG ' + recipient + b' :'
+		max_length = 512 - len(b':' + self.get_hostmask() + b' ' + command + line_prefix + b'\r\n')
+
+		for part in split_message(message, max_length, self.serverthread_object.server.max_reply_lines):
+			self.serverthread_object.send_line_raw(command + line_prefix + part)
 
 	def bot_response(self, recipient, message):
 		"""Prefix message with ZWSP and convert from unicode to bytestring if necessary."""
 		if isinstance(message, str):
 			message = message.encode('utf-8')
 
-		self.msg(recipient, '\u200b'.encode('utf-8') + message)
+		self.msg(recipient, message, line_prefix = '\u200b'.encode('utf-8'))
 
 	def nick(self, nick):
 		"""Send a NICK command and update the internal nick tracking state"""
@@ -93,12 +207,35 @@ class API:
 		with self.serverthread_object.nick_lock:
 			return self.serverthread_object.nick
 
-	def join(self, channel):
+	def get_network(self):
+		"""Returns the name of the network, None if it's the only one"""
+		return self.serverthread_object.server.name
+
+	def get_hostmask(self):
+		"""Returns nick!user@host as the server shows it to others. If we haven't seen it yet, returns the longest it could be"""
+		with self.serverthread_object.nick_lock:
+			if self.serverthread_object.hostmask is not None:
+				return self.serverthread_object.hostmask
+
+			# Usernames are at most 10 bytes, plus ~ for unidented, and hostnames at most 63 bytes
+			return self.serverthread_object.nick + b'!~' + b'u' * 10 + b'@' + b'h' * 63
+
+	def join(self, channel, key = None):
 		"""Send a JOIN command and update the internal channel tracking state"""
+		if key is None:
+			self.join_many([channel])
+		else:
+			self.join_many([channel], {channel: key})
+
+	def join_many(self, channels, keys = None):
+		"""Join several channels with as few JOIN commands as possible. keys maps channels to their keys, if they need one"""
+		if keys is None:
+			keys = {}
+
 		with self.serverthread_object.channels_lock:
-			line = b'JOIN ' + channel
-			self.serverthread_object.send_line_raw(line)
-			self.serverthread_object.channels.add(channel)
+			for line in join_lines(channels, keys):
+				self.serverthread_object.send_line_raw(line)
+			self.serverthread_object.channels.update(channels)
 
 	def part(self, channel, message = b''):
 		"""Send a PART command and update the internal channel tracking state"""
@@ -116,6 +253,213 @@ class API:
 		"""Log an error"""
 		self.serverthread_object.logging_channel.send((logmessage_types.internal, internal_submessage_types.error, message))
 
+# split_message(message, max_length, max_parts) → parts
+# Split message into parts of at most max_length bytes, at spaces where possible and never inside an UTF-8
+# character. If there would be more than max_parts parts, the last one is cut short and ends in '…'
+# max_length is raised to fit at least one character (up to 4 bytes) and the ellipsis, and max_parts to 1
+def split_message(message, max_length, max_parts):
+	ellipsis = '…'.encode('utf-8')
+
+	# Otherwise a very long prefix or a tiny max_reply_lines would leave parts with no room, never getting anywhere
+	max_length = max(max_length, 4 + len(ellipsis))
+	max_parts = max(max_parts, 1)
+
+	def character_boundary(index):
+		# Step back from UTF-8 continuation bytes to the start of the character
+		while index > 0 and message[index] & 0xc0 == 0x80:
+			index -= 1
+		return index
+
+	parts = []
+	while len(message) > max_length:
+		if len(parts) == max_parts - 1:
+			# Last part we can send, cut it to make room for the ellipsis
+			message = message[:character_boundary(max_length - len(ellipsis))] + ellipsis
+			break
+
+		# Split at the last space that fits, unless it leaves too short a part
+		split = message.rfind(b' ', 0, max_length + 1)
+		if split > max_length // 2:
+			parts.append(message[:split])
+			message = message[split + 1:]
+
+		else:
+			split = character_boundary(max_length)
+			if split == 0:
+				split = max_length
+			parts.append(message[:split])
+			message = message[split:]
+
+	parts.append(message)
+
+	return parts
+
+# join_lines(channels, keys) → lines
+# Pack JOINs for channels into as few lines of at most 510 bytes as possible. keys maps channels to their keys, if they
+# need one. The channels with keys go first in each line, since the server matches keys to channels by position
+def join_lines(channels, keys):
+	def join_line(line_channels, line_keys):
+		if len(line_keys) == 0:
+			return b'JOIN ' + b','.join(line_channels)
+		return b'JOIN ' + b','.join(line_channels) + b' ' + b','.join(line_keys)
+
+	keyed = [channel for channel in channels if channel in keys]
+	unkeyed = [channel for channel in channels if channel not in keys]
+
+	lines = []
+	line_channels = []
+	line_keys = []
+	length = len(b'JOIN ')
+	for channel in keyed + unkeyed:
+		# Room for the channel and the comma or space before it, and the same for the key
+		added = len(channel) + 1
+		if channel in keys:
+			added += len(keys[channel]) + 1
+
+		if len(line_channels) > 0 and length + added > 510:
+			lines.append(join_line(line_channels, line_keys))
+			line_channels = []
+			line_keys = []
+			length = len(b'JOIN ')
+
+		line_channels.append(channel)
+		if channel in keys:
+			line_keys.append(keys[channel])
+		length += added
+
+	if len(line_channels) > 0:
+		lines.append(join_line(line_channels, line_keys))
+
+	return lines
+
+# hostmask_from_line(command, line, nick, hostmask) → hostmask
+# Figure out our nick!user@host from a line from the server, if it tells us. Otherwise returns hostmask as is
+def hostmask_from_line(command, line, nick, hostmask):
+	line = line[line_handling.skip_tags(line):]
+
+	if command == b'JOIN':
+		# The server echoes our JOINs back with our full hostmask in the prefix
+		prefix = line[1:].split(b' ', 1)[0]
+		if line[:1] == b':' and prefix.split(b'!', 1)[0].lower() == nick.lower():
+			return prefix
+
+	elif command == b'001':
+		# RPL_WELCOME usually ends in our hostmask
+		last_word = line.rsplit(b' ', 1)[-1]
+		if b'!' in last_word and b'@' in last_word:
+			return last_word
+
+	elif command == b'396' and hostmask is not None:
+		# RPL_HOSTHIDDEN gives our new, cloaked host
+		arguments = line.split(b' ')
+		if len(arguments) >= 4:
+			return hostmask.split(b'@', 1)[0] + b'@' + arguments[3]
+
+	return hostmask
+
+# The parts of talking to a server that are the same in the threaded and the asyncio mode
+# server is a ServerThread or an asyncbot.AsyncServer
+
+# outgoing_line(line, priority) → line, priority, trace
+# Clean up a line to be sent and decide its priority, if not given. Replies hold a reference to the trace of the line
+# they are for until they have been written, so this takes one for the caller to release
+def outgoing_line(line, priority):
+	# Sanitize line just in case
+	line = line.replace(b'\r', b'').replace(b'\n', b'')[:510]
+
+	if priority is None:
+		priority = floodcontrol.priority_of(line)
+
+	trace = tracing.current()
+	if trace is not None:
+		trace.hold('enqueue')
+
+	return line, priority, trace
+
+# logged_when_sent(line) → logged
+# Whether to log a line once it has been sent. PINGs and PONGs aren't
+def logged_when_sent(line):
+	return not (len(line) >= 5 and (line[:5] == b'PING ' or line[:5] == b'PONG '))
+
+# handle_server_line(server, line, read_time, dispatch = line_handling.dispatch)
+# Handle a line read from server at read_time, queueing the work of handling it with dispatch
+def handle_server_line(server, line, read_time, dispatch = line_handling.dispatch):
+	server.lines_received += 1
+
+	start, end = line_handling.command_span(line)
+	command = line[start:end].upper()
+
+	# Only answer PINGs from the server itself, which have no prefix. Any tags are dropped from the PONG
+	if command == b'PING' and line[line_handling.skip_tags(line):][:1] != b':':
+		server.send_line_raw(b'PONG' + line[end:])
+	elif command == b'PONG':
+		# No need to do anything special for PONGs
+		pass
+	else:
+		server.logging_channel.send((logmessage_types.received, line))
+
+		# Keep track of how the server sees us, so we know how long our messages can be
+		if command in (b'JOIN', b'001', b'396'):
+			with server.nick_lock:
+				server.hostmask = hostmask_from_line(command, line, server.nick, server.hostmask)
+
+		trace = tracing.start(read_time, server.logging_channel)
+		line_handling.handle_line(line, irc = server.api, dispatch = dispatch, trace = trace)
+
+		# Done with the line here, the handlers hold their own references
+		if trace is not None:
+			trace.release()
+
+# WriterThread(server_socket, outbound_queue, logging_channel)
+# Sends the lines from outbound_queue to the server until the queue is closed
+class WriterThread(threading.Thread):
+	def __init__(self, server_socket, outbound_queue, logging_channel):
+		self.server_socket = server_socket
+		self.outbound_queue = outbound_queue
+		self.logging_channel = logging_channel
+
+		self.lines_sent = 0
+
+		threading.Thread.__init__(self)
+
+	def run(self):
+		while True:
+			item = self.outbound_queue.get()
+			if item is None:
+				break
+
+			line, trace = item
+
+			try:
+				self.server_socket.sendall(line + b'\r\n')
+
+			except OSError:
+				if trace is not None:
+					trace.release()
+
+				self.logging_channel.send((logmessage_types.internal, internal_submessage_types.error, 'Broken socket/pipe or timeout'))
+				self.outbound_queue.close()
+
+				# Make sure the main loop notices, by making the socket read as closed
+				try:
+					self.server_socket.shutdown(socket.SHUT_RDWR)
+				except OSError:
+					pass
+
+				break
+
+			self.lines_sent += 1
+
+			if trace is not None:
+				trace.release('write')
+
+			if logged_when_sent(line):
+				self.logging_channel.send((logmessage_types.sent, line))
+
+		# Nothing sends the lines left in the queue, so finish with their traces too
+		for line, trace in self.outbound_queue.drop_all():
+			if trace is not None:
+				trace.release('dropped')
 
 # ServerThread(server, control_channel, cron_control_channel, logging_channel)
 # Creates a new server main loop thread
@@ -126,55 +470,64 @@ class ServerThread(threading.Thread):
 		self.cron_control_channel = cron_control_channel
 		self.logging_channel = logging_channel
 
-		self.server_socket_write_lock = threading.Lock()
-
-		self.last_send = 0
-		self.last_send_lock = threading.Lock()
+		# Lines to send are queued for a WriterThread, created for each connection
+		self.outbound_queue = None
+		self.writer_thread = None
 
 		self.nick = None
+		self.hostmask = None
 		self.nick_lock = threading.Lock()
 
 		self.channels = set()
 		self.channels_lock = threading.Lock()
 
+		# Lines sent by earlier connections' writers are added here
+		self.lines_received = 0
+		self.lines_sent = 0
+
 		threading.Thread.__init__(self)
 
-	def send_line_raw(self, line):
-		# Sanitize line just in case
-		line = line.replace(b'\r', b'').replace(b'\n', b'')[:510]
-
-		with self.last_send_lock:
-			now = time.monotonic()
-			if now - self.last_send < 1:
-				# Schedule our message sending one second after the last one
-				self.last_send += 1
-				wait = self.last_send - now
-
-			else:
-				self.last_send = now
-				wait = 0
-
-		if wait > 0:
-			time.sleep(wait)
-
-		with self.server_socket_write_lock:
-			self.server_socket.sendall(line + b'\r\n')
-
-		# Don't log PINGs or PONGs
-		if not (len(line) >= 5 and (line[:5] == b'PING ' or line[:5] == b'PONG ')):
-			self.logging_channel.send((logmessage_types.sent, line.decode(encoding = 'utf-8', errors = 'replace')))
-
-	def handle_line(self, line):
-		command, _, arguments = line.partition(b' ')
-		split = line.split(b' ')
-		if len(split) >= 1 and split[0].upper() == b'PING':
-			self.send_line_raw(b'PONG ' + arguments)
-		elif len(split) >= 2 and split[0][0:1] == b':' and split[1].upper() == b'PONG':
-			# No need to do anything special for PONGs
-			pass
-		else:
-			self.logging_channel.send((logmessage_types.received, line.decode(encoding = 'utf-8', errors = 'replace')))
-			line_handling.handle_line(line, irc = self.api)
+	def send_line_raw(self, line, priority = None):
+		line, priority, trace = outgoing_line(line, priority)
+
+		# Never blocks, the writer thread takes care of flood control
+		# Lines sent when there is no connection are dropped
+		outbound_queue = self.outbound_queue
+		if outbound_queue is None or not outbound_queue.put((line, trace), priority, floodcontrol.is_registration(line)):
+			if trace is not None:
+				trace.release()
+
+	def start_writer(self):
+		self.outbound_queue = floodcontrol.OutboundQueue(self.server.flood_rate, self.server.flood_burst)
+		self.outbound_queue.allow_burst(self.server.register_burst)
+		self.writer_thread = WriterThread(self.server_socket, self.outbound_queue, self.logging_channel)
+		self.writer_thread.start()
+
+	def stop_writer(self):
+		# Let the writer send the remaining urgent lines (like QUIT), but don't wait for long
+		if self.outbound_queue is not None:
+			self.outbound_queue.close()
+			self.writer_thread.join(5)
+
+			self.lines_sent += self.writer_thread.lines_sent
+			self.outbound_queue = None
+			self.writer_thread = None
+
+	def stats(self):
+		"""Returns a NetworkStats for this network"""
+		outbound_queue = self.outbound_queue
+		writer_thread = self.writer_thread
+
+		connected = outbound_queue is not None
+		lines_sent = self.lines_sent
+		send_queue = 0
+		if connected:
+			lines_sent += writer_thread.lines_sent
+			send_queue = outbound_queue.qsize()
+
+		dropped_lines = line_handling.dropped_lines[self.server.name]
+
+		return NetworkStats(connected, self.lines_received, lines_sent, send_queue, dropped_lines)
 
 	def mainloop(self):
 		# Register both the server socket and the control channel to a polling object
@@ -182,8 +535,8 @@ class ServerThread(threading.Thread):
 		poll.register(self.server_socket, select.POLLIN)
 		poll.register(self.control_channel, select.POLLIN)
 
-		# Keep buffer for input
-		server_input_buffer = bytearray()
+		# Keep buffer for input. A line can be at most 512 bytes and 8191 bytes of tags, but leave some leeway
+		server_input_buffer = ReceiveBuffer(2 * self.server.read_size, 64 * 1024 + self.server.read_size)
 
 		quitting = False
 		reconnecting = False
@@ -194,28 +547,22 @@ class ServerThread(threading.Thread):
 				if fd == self.server_socket.fileno():
 					# Ready to receive, read into buffer and handle full messages
 					if event | select.POLLIN:
-						data = self.server_socket.recv(1024)
+						count = server_input_buffer.recv_from(self.server_socket, self.server.read_size)
+						read_time = time.monotonic()
 
 						# Mo data to be read even as POLLIN triggered → connection has broken
 						# Log it and try reconnecting
-						if data == b'':
+						if count == 0:
 							self.logging_channel.send((logmessage_types.internal, internal_submessage_types.error, 'Empty read'))
 							reconnecting = True
 							break
 
-						server_input_buffer.extend(data)
-
-						# Try to see if we have a full line ending with \r\n in the buffer
-						# If yes, handle it
-						while b'\r\n' in server_input_buffer:
-							# Newline was found, split buffer
-							line, _, server_input_buffer = server_input_buffer.partition(b'\r\n')
-
-							self.handle_line(line)
+						# Handle all full lines ending with \r\n we got
+						for line in server_input_buffer.lines():
+							handle_server_line(self, line, read_time)
 
-						# Remove possible pending ping timeout timer and reset ping timer to 3 minutes
-						cron.delete(self.cron_control_channel, self.control_channel, (controlmessage_types.ping_timeout,))
-						cron.reschedule(self.cron_control_channel, 3 * 60, self.control_channel, (controlmessage_types.ping,))
+						# Postpone the ping and ping timeout timers. They check this themselves when they come up
+						self.activity.touch()
 
 					else:
 						error_message = 'Event on server socket: %s' % event
@@ -236,8 +583,6 @@ class ServerThread(threading.Thread):
 					elif command_type == controlmessage_types.ping:
 						assert len(arguments) == 0
 						self.send_line_raw(b'PING :foo')
-						# Reset ping timeout timer to 2 minutes
-						cron.reschedule(self.cron_control_channel, 2 * 60, self.control_channel, (controlmessage_types.ping_timeout,))
 
 					elif command_type == controlmessage_types.ping_timeout:
 						self.logging_channel.send((logmessage_types.internal, internal_submessage_types.error, 'Ping timeout'))
@@ -269,7 +614,7 @@ class ServerThread(threading.Thread):
 				self.logging_channel.send((logmessage_types.internal, internal_submessage_types.error, "Can't connect to %s:%s" % address))
 
 				# Try reconnecting in a minute
-				cron.reschedule(self.cron_control_channel, 60, self.control_channel, (controlmessage_types.reconnect,))
+				reconnect_timer = cron.schedule(self.cron_control_channel, 60, self.control_channel, (controlmessage_types.reconnect,))
 
 				# Handle messages
 				reconnect = True
@@ -288,7 +633,7 @@ class ServerThread(threading.Thread):
 						self.logging_channel.send((logmessage_types.internal, internal_submessage_types.error, error_message))
 
 				# Remove the reconnect message in case we were told to reconnnect manually
-				cron.delete(self.cron_control_channel, self.control_channel, (controlmessage_types.reconnect,))
+				reconnect_timer.cancel()
 
 				if reconnect:
 					continue
@@ -297,6 +642,14 @@ class ServerThread(threading.Thread):
 
 			# Create an API object to give to outside line handler
 			self.api = API(self)
+			self.hostmask = None
+
+			self.start_writer()
+
+			# Send a ping after 3 minutes of no activity, and time out if there is still nothing 2 minutes later
+			self.activity = cron.Activity()
+			ping_timer = cron.schedule_idle(self.cron_control_channel, self.activity, 3 * 60, self.control_channel, (controlmessage_types.ping,))
+			ping_timeout_timer = cron.schedule_idle(self.cron_control_channel, self.activity, 5 * 60, self.control_channel, (controlmessage_types.ping_timeout,))
 
 			try:
 				# Run initialization
@@ -308,12 +661,8 @@ class ServerThread(threading.Thread):
 				# Run the on_connect hook, to allow further setup
 				botcmd.on_connect(irc = self.api)
 
-				# Join channels
-				for channel in self.server.channels:
-					self.api.join(channel.encode('utf-8'))
-
-				# Schedule a ping to be sent in 3 minutes of no activity
-				cron.reschedule(self.cron_control_channel, 3 * 60, self.control_channel, (controlmessage_types.ping,))
+				# Join channels, packing them into as few lines as we can
+				self.api.join_many(*encode_channels(self.server))
 
 				# Run mainloop
 				reconnecting = self.mainloop()
@@ -324,67 +673,201 @@ class ServerThread(threading.Thread):
 
 					# Tell the server we're quiting
 					self.send_line_raw(b'QUIT :%s exiting normally' % self.server.username.encode('utf-8'))
-					self.server_socket.close()
 
 					break
 
 				else:
 					# Tell server we're reconnecting
 					self.send_line_raw(b'QUIT :Reconnecting')
-					self.server_socket.close()
 
-			except (BrokenPipeError, TimeoutError) as err:
+			except (ConnectionError, TimeoutError) as err:
 				# Connection broke, log it and try to reconnect
 				self.logging_channel.send((logmessage_types.internal, internal_submessage_types.error, 'Broken socket/pipe or timeout'))
+
+			finally:
+				# The timers and the writer belong to this connection
+				ping_timer.cancel()
+				ping_timeout_timer.cancel()
+
+				self.stop_writer()
 				self.server_socket.close()
 
-		# Tell controller we're quiting
-		self.logging_channel.send((logmessage_types.internal, internal_submessage_types.quit))
+		# The logger and cron are shared between networks, so the main thread stops them once all have quit
 
-		# Tell cron we're quiting
-		cron.quit(cron_control_channel)
+# encode_channels(server) → channels, keys
+# Returns the channels to join on server and their keys as bytes, for API.join_many
+def encode_channels(server):
+	channels = [channel.encode('utf-8') for channel in server.channels]
+	channel_keys = server.channel_keys if server.channel_keys is not None else {}
+	keys = {channel.encode('utf-8'): key.encode('utf-8') for channel, key in channel_keys.items()}
+	return channels, keys
 
-# spawn_serverthread(server, cron_control_channel, logging_channel) → control_channel
-# Creates a ServerThread for given server and returns the channel for controlling it
+# spawn_serverthread(server, cron_control_channel, logging_channel) → control_channel, serverthread
+# Creates a ServerThread for given server and returns the channel for controlling it and the thread itself
 def spawn_serverthread(server, cron_control_channel, logging_channel):
-	thread_control_socket, spawner_control_socket = socket.socketpair()
 	control_channel = channel.Channel()
-	ServerThread(server, control_channel, cron_control_channel, logging_channel).start()
-	return control_channel
+	serverthread = ServerThread(server, control_channel, cron_control_channel, network_log(logging_channel, server))
+	serverthread.start()
+	return control_channel, serverthread
 
 # spawn_loggerthread() → logging_channel, dead_notify_channel
 # Spawn logger thread and returns the channel it logs and the channel it uses to notify about quiting
 def spawn_loggerthread():
-	logging_channel = channel.Channel()
+	logging_channel = logger.LogQueue(channel.Channel())
 	dead_notify_channel = channel.Channel()
 	LoggerThread(logging_channel, dead_notify_channel).start()
 	return logging_channel, dead_notify_channel
 
-# read_config() → config, server
-# Reads the configuration file and returns the configuration object as well as a server object for spawn_serverthread
+# register_metrics(networks, logging_channel, cron_control_channel)
+# Export the stats of the networks (name → object with a stats() method), the queue depths and the thread count as metrics
+def register_metrics(networks, logging_channel, cron_control_channel):
+	def network_metric(field):
+		return lambda: [((name or '',), getattr(network.stats(), field)) for name, network in networks.items()]
+
+	metrics.Gauge('hynneflip_lines_received_total', 'Lines received from the server', ['network'], network_metric('lines_received'), metric_type = 'counter')
+	metrics.Gauge('hynneflip_lines_sent_total', 'Lines sent to the server', ['network'], network_metric('lines_sent'), metric_type = 'counter')
+	metrics.Gauge('hynneflip_send_queue_depth', 'Lines waiting to be sent to the server', ['network'], network_metric('send_queue'))
+
+	metrics.Gauge('hynneflip_log_queue_depth', 'Log messages waiting to be written', [], lambda: [((), logging_channel.channel.qsize())])
+	metrics.Gauge('hynneflip_cron_queue_size', 'Timed events waiting to be run', [], lambda: [((), cron.queue_size(cron_control_channel))])
+	metrics.Gauge('hynneflip_threads', 'Threads running', [], lambda: [((), threading.active_count())])
+
+# read_server(section, name) → server
+# Reads a server object for spawn_serverthread from a section of the configuration file
+def read_server(section, name):
+	host = section['host']
+	port = int(section['port'])
+	nick = section['nick']
+	username = section['username']
+	realname = section['realname']
+
+	# Channels that need a key to join are listed as #channel:key
+	channels = []
+	channel_keys = {}
+	for channel in section['channels'].split():
+		channel, colon, key = channel.partition(':')
+		channels.append(channel)
+		if colon:
+			channel_keys[channel] = key
+
+	read_size = section.getint('read_size', Server._field_defaults['read_size'])
+	flood_rate = section.getfloat('flood_rate', Server._field_defaults['flood_rate'])
+	flood_burst = section.getint('flood_burst', Server._field_defaults['flood_burst'])
+	max_reply_lines = section.getint('max_reply_lines', Server._field_defaults['max_reply_lines'])
+	register_burst = section.getint('register_burst', Server._field_defaults['register_burst'])
+
+	return Server(host = host, port = port, nick = nick, username = username, realname = realname, channels = channels, read_size = read_size, flood_rate = flood_rate, flood_burst = flood_burst, max_reply_lines = max_reply_lines, name = name, channel_keys = channel_keys, register_burst = register_burst)
+
+# read_config() → config, servers
+# Reads the configuration file and returns the configuration object as well as a list of server objects for spawn_serverthread
 def read_config():
 	config = configparser.ConfigParser()
 	config.read('bot.conf')
 
-	host = config['server']['host']
-	port = int(config['server']['port'])
-	nick = config['server']['nick']
-	username = config['server']['username']
-	realname = config['server']['realname']
-	channels = config['server']['channels'].split()
+	# Each network has a [server:name] section. A lone network can use [server] instead
+	sections = [section for section in config.sections() if section == 'server' or section.startswith('server:')]
+	if len(sections) == 0:
+		raise ValueError('No [server] or [server:name] sections in bot.conf')
+
+	servers = []
+	for section in sections:
+		if section == 'server':
+			# Only name it if there are other networks to tell it apart from
+			name = None if len(sections) == 1 else config['server']['host']
+		else:
+			name = section[len('server:'):]
+
+		servers.append(read_server(config[section], name))
+
+	names = [server.name for server in servers]
+	if len(set(names)) != len(names):
+		raise ValueError('Two networks with the same name in bot.conf: %s' % ', '.join(map(str, names)))
+
+	return config, servers
+
+# split_console_command(cmd, names) → names, cmd
+# Console commands can be prefixed with 'name:' to only apply to that network. Returns the names of the networks the
+# command applies to and the command without the prefix
+def split_console_command(cmd, names):
+	name, colon, rest = cmd.partition(':')
+	if colon and name in names:
+		return [name], rest
+
+	return names, cmd
+
+# console_command(cmd, networks, reload_lexicon = botcmd.reload_lexicon) → quitting
+# Run a command typed into the console. networks maps names to the servers, and the ones told to quit are removed
+# from it and returned. reload_lexicon() is called to reload the lexicon
+def console_command(cmd, networks, reload_lexicon = botcmd.reload_lexicon):
+	names, cmd = split_console_command(cmd, list(networks))
+	quitting = []
 
-	server = Server(host = host, port = port, nick = nick, username = username, realname = realname, channels = channels)
+	if cmd == 'q':
+		print('Keyboard quit')
+		for name in names:
+			server = networks.pop(name)
+			server.control_channel.send((controlmessage_types.quit,))
+			quitting.append(server)
 
-	return config, server
+	elif cmd == 'r':
+		print('Keyboard reconnect')
+		for name in names:
+			networks[name].control_channel.send((controlmessage_types.reconnect,))
+
+	elif cmd == 'l':
+		print('Keyboard lexicon reload')
+		reload_lexicon()
+
+	elif cmd == 'c':
+		for name, stats in botcmd.cache_stats().items():
+			print('%s cache: %i hits, %i misses, %i/%i entries' % (name, *stats))
+
+	elif cmd == 's':
+		for name in names:
+			print_network_stats(name, networks[name].stats())
+
+	elif len(cmd) > 0 and cmd[0] == '/':
+		for name in names:
+			networks[name].control_channel.send((controlmessage_types.send_line, cmd[1:]))
+
+	return quitting
+
+def print_network_stats(name, stats):
+	if name is None:
+		prefix = ''
+	else:
+		prefix = '[%s] ' % name
+
+	state = 'connected' if stats.connected else 'not connected'
+	print('%s%s, %i lines received, %i sent, %i waiting to be sent, %i dropped' % (prefix, state, stats.lines_received, stats.lines_sent, stats.send_queue, stats.dropped_lines))
 
 if __name__ == '__main__':
-	config, server = read_config()
+	config, servers = read_config()
 
+	logger.initialize(config = config)
+	metrics.initialize(config = config)
+	tracing.initialize(config = config)
 	botcmd.initialize(config = config)
+	offload.initialize(config = config)
 
+	if config.get('bot', 'mode', fallback = 'threaded') == 'asyncio':
+		# Run the connection, timers, logging and line handling on one event loop instead
+		import asyncbot
+		asyncbot.run(config, servers)
+		sys.exit()
+
+	line_handling.initialize(config = config)
+
+	# All the networks share the cron thread, the logger and the lexicon
 	cron_control_channel = cron.start()
 	logging_channel, dead_notify_channel = spawn_loggerthread()
-	control_channel = spawn_serverthread(server, cron_control_channel, logging_channel)
+
+	# Network name → server thread
+	networks = {}
+	for server in servers:
+		control_channel, networks[server.name] = spawn_serverthread(server, cron_control_channel, logging_channel)
+
+	register_metrics(dict(networks), logging_channel, cron_control_channel)
 
 	while True:
 		message = dead_notify_channel.recv(blocking = False)
@@ -392,17 +875,13 @@ if __name__ == '__main__':
 			if message[0] == controlmessage_types.quit:
 				break
 
-		cmd = input('')
-		if cmd == 'q':
-			print('Keyboard quit')
-			control_channel.send((controlmessage_types.quit,))
+		for serverthread in console_command(input(''), networks):
+			serverthread.join()
+
+		# Keep the shared threads running until the last network has quit
+		if len(networks) == 0:
 			logging_channel.send((logmessage_types.internal, internal_submessage_types.quit))
 			cron.quit(cron_control_channel)
 			break
 
-		elif cmd == 'r':
-			print('Keyboard reconnect')
-			control_channel.send((controlmessage_types.reconnect,))
-
-		elif len(cmd) > 0 and cmd[0] == '/':
-			control_channel.send((controlmessage_types.send_line, cmd[1:]))
+	offload.shutdown()
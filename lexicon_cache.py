@@ -0,0 +1,98 @@
+import hashlib
+import os
+import pickle
+import struct
+
+# Compiled lexicon file layout:
+#   magic (8 bytes) | version (u32) | source mtime in ns (u64) | source size (u64) | source SHA-256 (32 bytes) | pickled data
+# The whole file is read in one go, and the header is checked before unpickling anything
+magic = b'HFLEXC\0\0'
+# Bump whenever the layout of the file or of the cached data changes
+version = 2
+
+header_format = '<8sIQQ32s'
+header_size = struct.calcsize(header_format)
+
+def source_checksum(source_path):
+	with open(source_path, 'rb') as f:
+		return hashlib.sha256(f.read()).digest()
+
+# load(cache_path, source_path) → data
+# Returns the data stored in the compiled file, or None if it is missing, unreadable or stale
+def load(cache_path, source_path):
+	try:
+		with open(cache_path, 'rb') as f:
+			contents = f.read()
+		source_stat = os.stat(source_path)
+	except OSError:
+		return None
+
+	if len(contents) < header_size:
+		return None
+
+	file_magic, file_version, source_mtime, source_size, checksum = struct.unpack_from(header_format, contents)
+
+	if file_magic != magic or file_version != version:
+		return None
+
+	touched = source_mtime != source_stat.st_mtime_ns or source_size != source_stat.st_size
+	if touched:
+		# The source has been touched, but might still have the same contents (e.g. after a checkout)
+		try:
+			if source_checksum(source_path) != checksum:
+				return None
+		except OSError:
+			return None
+
+	try:
+		data = pickle.loads(memoryview(contents)[header_size:])
+	except Exception:
+		# Corrupted or written by an incompatible version of the code, just recompile
+		return None
+
+	if touched:
+		# Record the new stat, so that the checksum isn't computed again on every load
+		header = struct.pack(header_format, magic, version, source_stat.st_mtime_ns, source_stat.st_size, checksum)
+		try:
+			replace_file(cache_path, lambda f: (f.write(header), f.write(memoryview(contents)[header_size:])))
+		except OSError:
+			pass
+
+	return data
+
+# replace_file(path, write)
+# Call write(f) on a temporary file and move it to path, so that readers never see a partially written file
+# The temporary file is removed if anything fails
+def replace_file(path, write):
+	temporary_path = '%s.%d.tmp' % (path, os.getpid())
+	try:
+		with open(temporary_path, 'wb') as f:
+			write(f)
+
+		os.replace(temporary_path, path)
+
+	except BaseException:
+		try:
+			os.unlink(temporary_path)
+		except OSError:
+			pass
+
+		raise
+
+# store(cache_path, source_path, data)
+# Write data into a compiled file for source_path. Failing to write is not an error, we just won't have a cache
+def store(cache_path, source_path, data):
+	try:
+		source_stat = os.stat(source_path)
+		checksum = source_checksum(source_path)
+
+		header = struct.pack(header_format, magic, version, source_stat.st_mtime_ns, source_stat.st_size, checksum)
+
+		def write(f):
+			f.write(header)
+			pickle.dump(data, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+		replace_file(cache_path, write)
+
+	except OSError:
+		pass
@@ -1,142 +1,330 @@
+import collections
+import queue
 import threading
+from collections import namedtuple
+from types import MappingProxyType
 
 import constants
+import metrics
+import tracing
 
 import botcmd
 
 class LineParsingError(Exception): None
 
-# parse_line(line) → prefix, command, arguments
-# Split the line into its component parts
+# tags maps the IRCv3 tag names to their unescaped values (b'' for tags without one)
+# prefix is None if the line had none, and the last of the arguments can contain spaces
+Message = namedtuple('Message', ['tags', 'prefix', 'command', 'arguments'])
+
+# Shared by all lines without tags, so it must not be modified
+no_tags = MappingProxyType({})
+
+# Escaped character in a tag value → what it stands for
+tag_escapes = {b':': b';', b's': b' ', b'\\': b'\\', b'r': b'\r', b'n': b'\n'}
+
+# parse_line(line) → message
+# Split the line into its component parts, as a Message
 def parse_line(line):
-	def read_byte():
-		# Read one byte and advance the index
-		nonlocal line, index
+	index = 0
 
-		if eol():
+	tags = no_tags
+	if line[:1] == b'@':
+		end = line.find(b' ')
+		if end == -1:
 			raise LineParsingError
 
-		byte = line[index]
-		index += 1
+		tags = parse_tags(line[1:end])
+		index = end + 1
 
-		return byte
+	# Any number of spaces can separate the parts
+	while line[index:index + 1] == b' ':
+		index += 1
 
-	def peek_byte():
-		# Look at current byte, don't advance index
-		nonlocal line, index
-		
-		if eol():
+	prefix = None
+	if line[index:index + 1] == b':':
+		end = line.find(b' ', index)
+		if end == -1:
 			raise LineParsingError
 
-		return line[index]
+		prefix = line[index + 1:end]
+		index = end + 1
 
-	def eol():
-		# Test if we've reached the end of the line
-		nonlocal line, index
-		return index >= len(line)
+	# Everything after the first ' :' is the last argument, as is
+	trailing_start = line.find(b' :', index)
+	if trailing_start == -1:
+		middle = line[index:]
+	else:
+		middle = line[index:trailing_start]
 
-	def skip_space():
-		# Skip until we run into a non-space character or eol.
-		while not eol() and peek_byte() == ord(' '):
-			read_byte()
+	parts = [part for part in middle.split(b' ') if part != b'']
+	if len(parts) == 0:
+		raise LineParsingError
 
-	def read_until_space():
-		nonlocal line, index
+	command = parts[0]
+	arguments = parts[1:]
 
-		if eol():
-			raise LineParsingError
+	if trailing_start != -1:
+		arguments.append(line[trailing_start + 2:])
 
-		# Try to find a space
-		until = line[index:].find(b' ')
+	return Message(tags, prefix, command, arguments)
 
-		if until == -1:
-			# Space not found, read until end of line
-			until = len(line)
-		else:
-			# Space found, add current index to it to get right index
-			until += index
+# parse_tags(data) → tags
+# Parse the 'key=value;key2' tags of a line, without the '@'
+def parse_tags(data):
+	tags = {}
 
-		# Slice line upto the point of next space / end and update index
-		data = line[index:until]
-		index = until
+	for tag in data.split(b';'):
+		if tag == b'':
+			continue
 
-		return data
+		key, _, value = tag.partition(b'=')
+		if b'\\' in value:
+			value = unescape_tag_value(value)
 
-	def read_until_end():
-		nonlocal line, index
+		tags[key] = value
 
-		if eol():
-			raise LineParsingError
-		
-		# Read all of the data, and make index point to eol
-		data = line[index:]
-		index = len(line)
+	return tags
 
-		return data
+def unescape_tag_value(value):
+	unescaped = bytearray()
 
 	index = 0
+	while True:
+		backslash = value.find(b'\\', index)
+		if backslash == -1:
+			unescaped += value[index:]
+			break
+
+		# Unknown escapes stand for the character itself, and a backslash at the end for nothing
+		unescaped += value[index:backslash]
+		escaped = value[backslash + 1:backslash + 2]
+		unescaped += tag_escapes.get(escaped, escaped)
+		index = backslash + 2
+
+	return bytes(unescaped)
+
+# Work is split into shards by where the response goes, each shard having one worker thread and a queue.
+# This keeps the responses to one channel or query in order, while different ones are handled in parallel
+# workers is the number of shards and queue_size how many items can wait in each one. overflow is what to do
+# when a shard's queue is full:
+#  drop-newest: drop the item that didn't fit
+#  drop-oldest: drop the item that has waited the longest to make room
+#  block: wait until there is room, which stops reading from the server meanwhile
+overflow_policies = ['drop-newest', 'drop-oldest', 'block']
+workers = 4
+queue_size = 256
+overflow = 'drop-newest'
+
+shard_queues = []
+
+# Network name → lines dropped on it
+dropped_lines = collections.Counter()
+dropped_lines_lock = threading.Lock()
+
+# queue_depths() → depths
+# Number of items waiting in each shard. The asyncio mode, which has shards of its own, replaces this
+def queue_depths():
+	return [shard_queue.qsize() for shard_queue in shard_queues]
+
+# Registered once, reading whatever the module globals are when the metrics are collected
+metrics.Gauge('hynneflip_dispatch_queue_depth', 'Lines waiting to be handled by each worker', ['worker'], lambda: [((str(index),), depth) for index, depth in enumerate(queue_depths())])
+metrics.Gauge('hynneflip_dropped_lines_total', 'Lines dropped because the workers were too busy', ['network'], lambda: [((network or '',), count) for network, count in list(dropped_lines.items())], metric_type = 'counter')
+
+# configure(*, config)
+# Read the [dispatch] settings, without starting the workers. The asyncio mode uses them for its own shards
+def configure(*, config):
+	global workers, queue_size, overflow
+
+	if 'dispatch' in config:
+		workers = config['dispatch'].getint('workers', workers)
+		queue_size = config['dispatch'].getint('queue_size', queue_size)
+		overflow = config['dispatch'].get('overflow', overflow)
+
+	if overflow not in overflow_policies:
+		raise ValueError('Unknown overflow policy %s, should be one of %s' % (overflow, ', '.join(overflow_policies)))
+
+def initialize(*, config):
+	global shard_queues
+
+	configure(config = config)
+
+	shard_queues = [queue.Queue(queue_size) for _ in range(workers)]
+
+	for shard_queue in shard_queues:
+		LineHandlerThread(shard_queue).start()
+
+# skip_tags(line) → index
+# Index where the line continues after its IRCv3 tags and the spaces after them, 0 if it has none
+def skip_tags(line):
+	if line[:1] != b'@':
+		return 0
+
+	index = line.find(b' ')
+	if index == -1:
+		return len(line)
+
+	while line[index:index + 1] == b' ':
+		index += 1
 
-	prefix = None
-	command = None
-	arguments = []
+	return index
 
-	if peek_byte() == ord(':'):
-		read_byte()
-		prefix = read_until_space()
+# command_span(line) → start, end
+# Where the command of a line is, without parsing all of it. start == end if there is no command
+def command_span(line):
+	start = skip_tags(line)
 
-	skip_space()
+	if line[start:start + 1] == b':':
+		# Skip the prefix
+		start = line.find(b' ', start)
+		if start == -1:
+			return len(line), len(line)
 
-	command = read_until_space()
+	# Skip the spaces before the command
+	while line[start:start + 1] == b' ':
+		start += 1
 
-	skip_space()
+	end = line.find(b' ', start)
+	if end == -1:
+		end = len(line)
 
-	while not eol():
-		if peek_byte() == ord(':'):
-			read_byte()
-			argument = read_until_end()
-		else:
-			argument = read_until_space()
+	return start, end
 
-		arguments.append(argument)
+# peek_command(line) → command
+# Get the command of a line without parsing all of it. Returns None if there is no command
+def peek_command(line):
+	start, end = command_span(line)
 
-		skip_space()
+	if start == end:
+		return None
 
-	return prefix, command, arguments
+	return line[start:end]
 
-class LineHandlerThread(threading.Thread):
-	def __init__(self, line, *, irc):
-		self.line = line
-		self.irc = irc
+def is_handled(line):
+	# PRIVMSGs go to botcmd.handle_message, everything else only if botcmd has asked for it
+	command = peek_command(line)
 
-		threading.Thread.__init__(self)
+	if command is None:
+		# Let the parser complain about it
+		return True
 
-	def run(self):
-		try:
-			prefix, command, arguments = parse_line(self.line)
-		except LineParsingError:
-			irc.error("Cannot parse line" + self.line.decode(encoding = 'utf-8', errors = 'replace'))
+	command = command.upper()
+	return command == b'PRIVMSG' or command in botcmd.nonmessage_commands
 
-		if command.upper() == b'PRIVMSG':
-			# PRIVMSG should have two parameters: recipient and the message
-			assert len(arguments) == 2
-			recipients, message = arguments
+def drop_work(irc, trace):
+	network = irc.get_network()
 
-			# Prefix contains the nick of the sender, delimited from user and host by '!'
-			nick = prefix.split(b'!')[0]
+	if trace is not None:
+		trace.release('dropped')
 
-			# Recipients are in a comma-separate list
-			for recipient in recipients.split(b','):
-				# 'channel' is bit of a misnomer. This is where we'll send the response to
-				# Usually it's the channel, but in queries it's not
-				channel = recipient if recipient[0] == ord('#') else nick
+	with dropped_lines_lock:
+		dropped_lines[network] += 1
+		dropped = dropped_lines[network]
 
-				# Delegate rest to botcmd.handle_message
-				botcmd.handle_message(prefix = prefix, message = message, nick = nick, channel = channel, irc = self.irc)
+	# Don't flood the log when we're already overloaded
+	if dropped == 1 or dropped % 100 == 0:
+		irc.error('Line handling queue full, %i lines dropped so far' % dropped)
 
-		else:
-			# Delegate to botcmd.handle_nonmessage
-			botcmd.handle_nonmessage(prefix = prefix, command = command, arguments = arguments, irc = self.irc)
+class LineHandlerThread(threading.Thread):
+	def __init__(self, shard_queue):
+		self.shard_queue = shard_queue
+
+		threading.Thread.__init__(self, daemon = True)
 
-def handle_line(line, *, irc):
-	# Spawn a thread to handle the line
-	LineHandlerThread(line, irc = irc).start()
+	def run(self):
+		while True:
+			irc, handler, arguments, trace = self.shard_queue.get()
+
+			try:
+				with tracing.activate(trace):
+					handler(**arguments, irc = irc)
+			except Exception as err:
+				# Keep the worker alive for the next item
+				irc.error('Error in %s: %s' % (handler.__name__, repr(err)))
+
+# dispatch(key, handler, arguments, *, irc, trace = None)
+# Queue handler(**arguments, irc = irc) to be run on the shard for key. Work with the same key and irc is run in order
+# The handler holds a reference to trace until it has run
+def dispatch(key, handler, arguments, *, irc, trace = None):
+	# Lines from the server can be bytearrays, whose parts aren't hashable
+	if isinstance(key, bytearray):
+		key = bytes(key)
+
+	shard_queue = shard_queues[hash((id(irc), key)) % len(shard_queues)]
+	work = (irc, handler, arguments, trace)
+
+	if trace is not None:
+		trace.hold('dispatch')
+
+	if overflow == 'block':
+		shard_queue.put(work)
+		return
+
+	try:
+		shard_queue.put_nowait(work)
+
+	except queue.Full:
+		if overflow == 'drop-oldest':
+			# Make room by dropping the oldest item. The worker may have made room meanwhile, so this can fail
+			try:
+				oldest_irc, _, _, oldest_trace = shard_queue.get_nowait()
+				drop_work(oldest_irc, oldest_trace)
+			except queue.Empty:
+				pass
+
+			try:
+				shard_queue.put_nowait(work)
+			except queue.Full:
+				drop_work(irc, trace)
+
+		else:
+			drop_work(irc, trace)
+
+# handle_line(line, *, irc, dispatch = dispatch, trace = None)
+# Parse the line and queue handling it with dispatch, which has the same signature as dispatch() above
+def handle_line(line, *, irc, dispatch = dispatch, trace = None):
+	# The line can be a bytearray, but parts of it are used as dictionary keys
+	line = bytes(line)
+
+	# Drop lines nobody would do anything with before parsing them
+	if not is_handled(line):
+		return
+
+	try:
+		message = parse_line(line)
+	except LineParsingError:
+		irc.error("Cannot parse line" + line.decode(encoding = 'utf-8', errors = 'replace'))
+		return
+
+	tags, prefix, command, arguments = message
+
+	if trace is not None:
+		trace.mark('parse')
+		trace.description = command.decode(encoding = 'utf-8', errors = 'replace')
+		if len(arguments) > 0:
+			trace.description += ' ' + arguments[0].decode(encoding = 'utf-8', errors = 'replace')
+
+	if command.upper() == b'PRIVMSG':
+		# PRIVMSG should have two parameters: recipient and the message
+		if len(arguments) != 2:
+			irc.error("Malformed PRIVMSG" + line.decode(encoding = 'utf-8', errors = 'replace'))
+			return
+
+		recipients, message = arguments
+
+		# Prefix contains the nick of the sender, delimited from user and host by '!'
+		nick = prefix.split(b'!')[0] if prefix is not None else b''
+
+		# Recipients are in a comma-separate list
+		for recipient in recipients.split(b','):
+			# 'channel' is bit of a misnomer. This is where we'll send the response to
+			# Usually it's the channel, but in queries it's not
+			channel = recipient if recipient[0:1] == b'#' else nick
+
+			# Delegate rest to botcmd.handle_message, on the shard of the place where the response goes
+			arguments = {'tags': tags, 'prefix': prefix, 'message': message, 'nick': nick, 'channel': channel}
+			dispatch(channel.lower(), botcmd.handle_message, arguments, irc = irc, trace = trace)
+
+	else:
+		# Delegate to botcmd.handle_nonmessage, keeping the lines from one source in order
+		arguments = {'tags': tags, 'prefix': prefix, 'command': command, 'arguments': arguments}
+		dispatch(prefix, botcmd.handle_nonmessage, arguments, irc = irc, trace = trace)
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+import argparse
+import configparser
+import json
+import platform
+import select
+import socket
+import sys
+import time
+
+import botcmd
+import cron
+import ircbot
+import line_handling
+import logger
+from constants import controlmessage_types, logmessage_types, internal_submessage_types
+
+# End-to-end load test
+# Runs the bot's ServerThread in this process against a scripted stand-in IRC server on a loopback socket, and
+# measures how quickly and reliably it replies. Needs no network, only the lexicon files in the current directory
+
+nick = 'HynneFlip'
+
+# Commands the simulated users send, in turn
+command_mix = ['hymmnos ale', 'pastalie bAlduo', 'gloss Was yea ra chs hymmnos mea.', 'english song', 'help']
+
+class FakeServer:
+	"""Stand-in IRC server on a loopback socket, for one connection from the bot at a time."""
+
+	def __init__(self):
+		self.listener = socket.socket()
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(1)
+		self.port = self.listener.getsockname()[1]
+
+		self.connection = None
+		self.buffer = b''
+
+	def accept(self, timeout):
+		"""Wait up to timeout seconds for the bot to connect. Returns whether it did"""
+		readable, _, _ = select.select([self.listener], [], [], timeout)
+		if len(readable) == 0:
+			return False
+
+		self.connection, _ = self.listener.accept()
+		self.buffer = b''
+		return True
+
+	def send(self, line):
+		try:
+			self.connection.sendall(line + b'\r\n')
+		except OSError:
+			self.disconnect()
+
+	def read_lines(self, timeout):
+		"""Returns the lines received within timeout seconds, or None if the bot disconnected"""
+		readable, _, _ = select.select([self.connection], [], [], max(timeout, 0))
+		if len(readable) == 0:
+			return []
+
+		try:
+			data = self.connection.recv(65536)
+		except OSError:
+			data = b''
+
+		if len(data) == 0:
+			self.disconnect()
+			return None
+
+		self.buffer += data
+		*lines, self.buffer = self.buffer.split(b'\r\n')
+		return lines
+
+	def disconnect(self):
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+
+	def close(self):
+		self.disconnect()
+		self.listener.close()
+
+# percentiles(values) → {name: value}
+def percentiles(values):
+	if len(values) == 0:
+		return {}
+
+	values = sorted(values)
+
+	def percentile(q):
+		return values[min(len(values) - 1, int(q * len(values)))]
+
+	return {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99), 'max': values[-1], 'mean': sum(values) / len(values)}
+
+class Scenario:
+	"""Scripted traffic from the server side, and the measurements of how the bot responded to it."""
+
+	def __init__(self, options, server):
+		self.options = options
+		self.server = server
+
+		self.channels = ['#load%i' % index for index in range(options.channels)]
+		self.joined = []
+
+		# Every command comes from a nick of its own, so that the reply can be matched to it by the nick in front
+		# Nick → time the command was sent
+		self.pending = {}
+		self.command_number = 0
+		self.latencies = []
+
+		# Ping token → time the ping was sent
+		self.pending_pings = {}
+		self.ping_number = 0
+		self.pong_latencies = []
+
+		self.flood_number = 0
+
+		self.connections = 0
+		self.disconnected_at = None
+		self.reconnect_times = []
+
+		self.counts = {'commands_sent': 0, 'replies': 0, 'lost_to_disconnect': 0, 'pings_sent': 0, 'ping_timeouts': 0, 'server_disconnects': 0, 'flood_lines_sent': 0, 'lines_from_bot': 0}
+
+	def handle_line(self, line, now):
+		self.counts['lines_from_bot'] += 1
+
+		command, _, rest = line.partition(b' ')
+		command = command.upper()
+
+		if command == b'USER':
+			self.server.send(b':fake.server 001 %s :Welcome to the load test %s!hf@loadtest' % (nick.encode(), nick.encode()))
+
+		elif command == b'PING':
+			self.server.send(b':fake.server PONG fake.server ' + rest)
+
+		elif command == b'PONG':
+			token = rest.rsplit(b':', 1)[-1]
+			if token in self.pending_pings:
+				self.pong_latencies.append(now - self.pending_pings.pop(token))
+
+		elif command == b'JOIN':
+			for channel in rest.split(b' ')[0].split(b','):
+				self.server.send(b':%s!hf@loadtest JOIN %s' % (nick.encode(), channel))
+				self.server.send(b':fake.server 353 %s = %s :%s @op' % (nick.encode(), channel, nick.encode()))
+				self.server.send(b':fake.server 366 %s %s :End of /NAMES list.' % (nick.encode(), channel))
+				self.joined.append(channel)
+
+			if self.disconnected_at is not None and len(self.joined) == len(self.channels):
+				self.reconnect_times.append(now - self.disconnected_at)
+				self.disconnected_at = None
+
+		elif command == b'PRIVMSG':
+			# Replies are 'PRIVMSG #channel :nick: …', and long ones can take several lines
+			_, _, message = rest.partition(b' :')
+			sender = message.split(b':', 1)[0]
+			if sender in self.pending:
+				self.latencies.append(now - self.pending.pop(sender))
+				self.counts['replies'] += 1
+
+	def send_command(self, now):
+		channel = self.joined[self.command_number % len(self.joined)]
+		sender = b'u%i' % self.command_number
+		command = command_mix[self.command_number % len(command_mix)].encode('utf-8')
+		self.command_number += 1
+
+		self.pending[sender] = now
+		self.counts['commands_sent'] += 1
+		self.server.send(b':%s!u@sim PRIVMSG %s :%s: %s' % (sender, channel, nick.encode(), command))
+
+	def send_flood(self):
+		# Alternate between others joining and NAMES replies, neither of which the bot acts on
+		channel = self.joined[self.flood_number % len(self.joined)]
+		if self.flood_number % 2 == 0:
+			self.server.send(b':j%i!u@sim JOIN %s' % (self.flood_number, channel))
+		else:
+			self.server.send(b':fake.server 353 %s = %s :a%i b%i c%i d%i' % (nick.encode(), channel, *[self.flood_number] * 4))
+
+		self.flood_number += 1
+		self.counts['flood_lines_sent'] += 1
+
+	def send_ping(self, now):
+		token = b'lt%i' % self.ping_number
+		self.ping_number += 1
+
+		self.pending_pings[token] = now
+		self.counts['pings_sent'] += 1
+		self.server.send(b'PING :' + token)
+
+	def check_ping_timeouts(self, now):
+		for token, sent in list(self.pending_pings.items()):
+			if now - sent > self.options.ping_timeout:
+				del self.pending_pings[token]
+				self.counts['ping_timeouts'] += 1
+
+	def disconnect(self, now):
+		# The commands in flight will never be answered
+		self.counts['lost_to_disconnect'] += len(self.pending)
+		self.pending.clear()
+		self.pending_pings.clear()
+
+		self.server.disconnect()
+		self.counts['server_disconnects'] += 1
+		self.disconnected_at = now
+
+	def run(self):
+		start = time.monotonic()
+		end = start + self.options.duration
+		drain_end = end + self.options.drain
+
+		command_interval = 1 / self.options.rate if self.options.rate > 0 else None
+		flood_interval = 1 / self.options.flood if self.options.flood > 0 else None
+
+		next_command = start
+		next_flood = start
+		next_ping = start + self.options.ping_interval
+		next_disconnect = start + self.options.disconnect_every if self.options.disconnect_every > 0 else None
+
+		while True:
+			now = time.monotonic()
+			if now >= drain_end or (now >= end and len(self.pending) == 0):
+				break
+
+			if self.server.connection is None:
+				if self.server.accept(0.1):
+					self.connections += 1
+					self.joined = []
+				continue
+
+			# Wait for lines from the bot until the next thing we have to do
+			due = [drain_end]
+			if now < end:
+				due.append(next_ping)
+				if len(self.joined) > 0:
+					due += [time for time in (next_command, next_flood, next_disconnect) if time is not None]
+
+			lines = self.server.read_lines(min(due) - now)
+			now = time.monotonic()
+
+			if lines is None:
+				# The bot hung up on us
+				self.disconnected_at = now
+				continue
+
+			for line in lines:
+				self.handle_line(line, now)
+
+			self.check_ping_timeouts(now)
+
+			if now >= end or self.server.connection is None:
+				continue
+
+			if now >= next_ping:
+				self.send_ping(now)
+				next_ping += self.options.ping_interval
+
+			if len(self.joined) == 0:
+				# Not in any channel yet, the bot is still registering
+				next_command = next_flood = now
+				continue
+
+			while command_interval is not None and now >= next_command:
+				self.send_command(now)
+				next_command += command_interval
+
+			while flood_interval is not None and now >= next_flood:
+				self.send_flood()
+				next_flood += flood_interval
+
+			if next_disconnect is not None and now >= next_disconnect:
+				self.disconnect(now)
+				next_disconnect += self.options.disconnect_every
+
+	def report(self):
+		report = dict(self.counts)
+		report['dropped_replies'] = len(self.pending)
+		report['connections'] = self.connections
+		report['latency_seconds'] = percentiles(self.latencies)
+		report['pong_latency_seconds'] = percentiles(self.pong_latencies)
+		report['reconnect_seconds'] = percentiles(self.reconnect_times)
+		report['options'] = vars(self.options)
+		report['python'] = platform.python_implementation() + ' ' + platform.python_version()
+
+		return report
+
+# start_bot(port, options) → control_channel, serverthread, logging_channel, cron_control_channel
+# Start the threaded bot in this process, connecting to the fake server on port
+def start_bot(port, options):
+	config = configparser.ConfigParser()
+	config.read_dict({
+		'dispatch': {'workers': str(options.workers), 'overflow': options.overflow},
+		'log': {'level': 'traffic' if options.log is not None else 'error'},
+	})
+	if options.log is not None:
+		config['log']['file'] = options.log
+
+	logger.initialize(config = config)
+	botcmd.initialize(config = config)
+	line_handling.initialize(config = config)
+
+	channels = ['#load%i' % index for index in range(options.channels)]
+	server = ircbot.Server(host = '127.0.0.1', port = port, nick = nick, username = 'hf', realname = 'load test', channels = channels, flood_rate = options.flood_rate, flood_burst = options.flood_burst)
+
+	cron_control_channel = cron.start()
+	logging_channel, dead_notify_channel = ircbot.spawn_loggerthread()
+	control_channel, serverthread = ircbot.spawn_serverthread(server, cron_control_channel, logging_channel)
+
+	return control_channel, serverthread, logging_channel, cron_control_channel
+
+def stop_bot(control_channel, serverthread, logging_channel, cron_control_channel):
+	control_channel.send((controlmessage_types.quit,))
+	serverthread.join()
+	logging_channel.send((logmessage_types.internal, internal_submessage_types.quit))
+	cron.quit(cron_control_channel)
+
+# compare(report, baseline, tolerance) → lines, regressions
+# Anything in the report that is worse than in baseline by more than tolerance (0.25 = 25 %) is a regression
+def compare(report, baseline, tolerance):
+	lines = []
+	regressions = []
+
+	measurements = [('latency p50', ('latency_seconds', 'p50')), ('latency p99', ('latency_seconds', 'p99')), ('pong latency p99', ('pong_latency_seconds', 'p99')), ('reconnect p50', ('reconnect_seconds', 'p50'))]
+	for name, (group, key) in measurements:
+		value = report[group].get(key)
+		baseline_value = baseline.get(group, {}).get(key)
+		if value is None or not baseline_value:
+			continue
+
+		change = value / baseline_value - 1
+		marker = ''
+		if change > tolerance:
+			marker = '  REGRESSION'
+			regressions.append(name)
+		lines.append('%-20s %10.1f ms %+8.1f %%%s' % (name, value * 1000, change * 100, marker))
+
+	# Lost replies and ping timeouts shouldn't grow at all
+	for name in ('dropped_replies', 'ping_timeouts'):
+		if name in baseline and report[name] > baseline[name]:
+			lines.append('%-20s %10i    was %i  REGRESSION' % (name, report[name], baseline[name]))
+			regressions.append(name)
+
+	return lines, regressions
+
+def print_report(report):
+	print('%i commands sent, %i replies, %i dropped, %i lost to disconnects' % (report['commands_sent'], report['replies'], report['dropped_replies'], report['lost_to_disconnect']))
+	print('%i pings sent, %i timed out; %i connections, %i server disconnects; %i flood lines' % (report['pings_sent'], report['ping_timeouts'], report['connections'], report['server_disconnects'], report['flood_lines_sent']))
+
+	for name in ('latency_seconds', 'pong_latency_seconds', 'reconnect_seconds'):
+		stats = report[name]
+		if len(stats) > 0:
+			print('%s: %s' % (name, ', '.join('%s %.1f ms' % (key, stats[key] * 1000) for key in ('p50', 'p90', 'p99', 'max', 'mean'))))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Load test the bot against a local stand-in IRC server')
+	parser.add_argument('--duration', type = float, default = 30, help = 'seconds to send traffic for')
+	parser.add_argument('--drain', type = float, default = 10, help = 'seconds to wait for the remaining replies afterwards')
+	parser.add_argument('--channels', type = int, default = 20, help = 'channels the bot is on')
+	parser.add_argument('--rate', type = float, default = 0.8, help = 'commands per second, spread over the channels')
+	parser.add_argument('--flood', type = float, default = 50, help = 'JOIN and NAMES lines per second the bot ignores')
+	parser.add_argument('--ping-interval', type = float, default = 5, help = 'seconds between PINGs from the server')
+	parser.add_argument('--ping-timeout', type = float, default = 10, help = 'seconds after which an unanswered PING counts as timed out')
+	parser.add_argument('--disconnect-every', type = float, default = 0, help = 'seconds between the server dropping the connection, 0 for never')
+	parser.add_argument('--flood-rate', type = float, default = ircbot.Server._field_defaults['flood_rate'], help = "the bot's flood control rate in lines per second")
+	parser.add_argument('--flood-burst', type = int, default = ircbot.Server._field_defaults['flood_burst'], help = "the bot's flood control burst")
+	parser.add_argument('--workers', type = int, default = line_handling.workers, help = 'line handling workers')
+	parser.add_argument('--overflow', default = line_handling.overflow, help = 'line handling overflow policy')
+	parser.add_argument('--log', help = "write the bot's log to this file")
+	parser.add_argument('--json', help = 'write the report as JSON to this file')
+	parser.add_argument('--baseline', help = 'compare against a report saved earlier with --json')
+	parser.add_argument('--tolerance', type = float, default = 0.25, help = 'how much worse than the baseline counts as a regression')
+	options = parser.parse_args()
+
+	server = FakeServer()
+	bot = start_bot(server.port, options)
+
+	try:
+		scenario = Scenario(options, server)
+		scenario.run()
+	finally:
+		stop_bot(*bot)
+		server.close()
+
+	report = scenario.report()
+	print_report(report)
+
+	if options.json is not None:
+		with open(options.json, 'w') as f:
+			json.dump(report, f, indent = '\t', sort_keys = True)
+			f.write('\n')
+
+	if options.baseline is not None:
+		with open(options.baseline, 'r') as f:
+			baseline = json.load(f)
+
+		lines, regressions = compare(report, baseline, options.tolerance)
+		for line in lines:
+			print(line)
+
+		if len(regressions) > 0:
+			print('%i regressions: %s' % (len(regressions), ', '.join(regressions)), file = sys.stderr)
+			sys.exit(1)
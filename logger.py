@@ -0,0 +1,208 @@
+import itertools
+import os
+import sys
+import threading
+
+from constants import logmessage_types, internal_submessage_types, loglevel_types
+
+# Least important messages that get logged
+level = loglevel_types.traffic
+# Only one in traffic_sample lines sent to or received from servers is logged
+traffic_sample = 1
+# File to log into, or None to log to stdout
+path = None
+# The log file is rotated once it grows past max_bytes, keeping backups old ones
+max_bytes = 10 * 1024 * 1024
+backups = 5
+# Messages that can wait to be written before new ones get dropped
+queue_size = 10000
+
+def initialize(*, config):
+	global level, traffic_sample, path, max_bytes, backups, queue_size
+
+	if 'log' in config:
+		level_name = config['log'].get('level', level.name)
+		if level_name not in loglevel_types.__members__:
+			raise ValueError('Unknown log level %s, should be one of %s' % (level_name, ', '.join(loglevel_types.__members__)))
+		level = loglevel_types[level_name]
+
+		traffic_sample = max(1, config['log'].getint('traffic_sample', traffic_sample))
+		path = config['log'].get('file', path)
+		max_bytes = config['log'].getint('max_bytes', max_bytes)
+		backups = config['log'].getint('backups', backups)
+		queue_size = config['log'].getint('queue_size', queue_size)
+
+# level_of(message) → level
+def level_of(message):
+	message_type, *message_data = message
+
+	if message_type == logmessage_types.network:
+		return level_of(message_data[1])
+
+	elif message_type in (logmessage_types.sent, logmessage_types.received):
+		return loglevel_types.traffic
+
+	elif message_type == logmessage_types.internal and message_data[0] == internal_submessage_types.error:
+		return loglevel_types.error
+
+	return loglevel_types.info
+
+# is_quit(message) → quit
+# The quit message tells the logger to stop, so it has to get through no matter what
+def is_quit(message):
+	return message[0] == logmessage_types.internal and message[1] == internal_submessage_types.quit
+
+class LogQueue:
+	"""Filters log messages before they are queued into channel for the logger. Messages below the log level and
+	traffic not picked by sampling are thrown away, and once the queue is full new messages are dropped and counted
+	instead of waiting for the logger to catch up."""
+
+	def __init__(self, channel):
+		self.channel = channel
+
+		self.traffic_counter = itertools.count()
+
+		self.dropped = 0
+		self.dropped_lock = threading.Lock()
+
+	def send(self, message):
+		if not is_quit(message):
+			message_level = level_of(message)
+			if message_level.value < level.value:
+				return
+
+			if message_level == loglevel_types.traffic and next(self.traffic_counter) % traffic_sample != 0:
+				return
+
+			if self.channel.qsize() >= queue_size:
+				with self.dropped_lock:
+					self.dropped += 1
+				return
+
+		self.channel.send(message)
+
+	def recv_many(self):
+		return self.channel.recv_many()
+
+	def take_dropped(self):
+		"""Returns how many messages have been dropped since the last call"""
+		with self.dropped_lock:
+			dropped = self.dropped
+			self.dropped = 0
+			return dropped
+
+# format_message(message_type, message_data, prefix = '') → text
+# Lines sent to or received from servers are passed as bytes and decoded only here, once we know they get logged
+def format_message(message_type, message_data, prefix = ''):
+	# Lines that were sent between server and client
+	if message_type == logmessage_types.sent:
+		assert len(message_data) == 1
+		return prefix + '>' + decode(message_data[0])
+
+	elif message_type == logmessage_types.received:
+		assert len(message_data) == 1
+		return prefix + '<' + decode(message_data[0])
+
+	# Messages that are from internal components
+	elif message_type == logmessage_types.internal:
+		if message_data[0] == internal_submessage_types.quit:
+			assert len(message_data) == 1
+			return prefix + '--- Quit'
+
+		elif message_data[0] == internal_submessage_types.error:
+			assert len(message_data) == 2
+			return prefix + '--- Error ' + str(message_data[1])
+
+		elif message_data[0] == internal_submessage_types.slow:
+			assert len(message_data) == 2
+			return prefix + '--- Slow ' + message_data[1]
+
+		else:
+			return prefix + '--- ??? ' + repr(message_data)
+
+	# Any of the above, about one of several networks
+	elif message_type == logmessage_types.network:
+		assert len(message_data) == 2
+		name, (message_type, *message_data) = message_data
+		return format_message(message_type, message_data, prefix = prefix + '[%s] ' % name)
+
+	else:
+		return prefix + '??? %s %s' % (message_type, repr(message_data))
+
+def decode(line):
+	if isinstance(line, str):
+		return line
+
+	return line.decode(encoding = 'utf-8', errors = 'replace')
+
+class LogFile:
+	"""Log file that is moved to path.1 once it grows past max_bytes, moving path.1 to path.2 and so on, and keeping
+	backups old files."""
+
+	def __init__(self, path, max_bytes, backups):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backups = backups
+
+		self.open()
+
+	def open(self):
+		self.file = open(self.path, 'ab')
+		self.size = self.file.tell()
+
+	def write(self, text):
+		data = text.encode('utf-8')
+		self.file.write(data)
+		self.file.flush()
+
+		self.size += len(data)
+		if self.size >= self.max_bytes:
+			self.rotate()
+
+	def rotate(self):
+		self.file.close()
+
+		if self.backups > 0:
+			for number in range(self.backups - 1, 0, -1):
+				if os.path.exists('%s.%i' % (self.path, number)):
+					os.replace('%s.%i' % (self.path, number), '%s.%i' % (self.path, number + 1))
+
+			os.replace(self.path, self.path + '.1')
+
+		else:
+			os.remove(self.path)
+
+		self.open()
+
+	def close(self):
+		self.file.close()
+
+class Stdout:
+	"""Stand-in for LogFile that writes to stdout"""
+
+	def write(self, text):
+		sys.stdout.write(text)
+		sys.stdout.flush()
+
+	def close(self):
+		sys.stdout.flush()
+
+# open_output() → output
+# Returns where to write the log as configured
+def open_output():
+	if path is None:
+		return Stdout()
+
+	return LogFile(path, max_bytes, backups)
+
+# write_messages(output, messages, dropped)
+# Format messages and write them to output with a single write, noting how many were dropped before them
+def write_messages(output, messages, dropped):
+	lines = []
+	if dropped > 0:
+		lines.append('--- %i log messages dropped' % dropped)
+
+	for message_type, *message_data in messages:
+		lines.append(format_message(message_type, message_data))
+
+	output.write(''.join(line + '\n' for line in lines))
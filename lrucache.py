@@ -0,0 +1,45 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'size', 'maxsize'])
+
+class LRUCache:
+	"""A thread-safe mapping that holds at most maxsize items, dropping the least recently used ones first."""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+
+		self.items = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def get(self, key, default = None):
+		"""Returns the value for key and marks it as recently used, or default if it isn't cached"""
+		with self.lock:
+			try:
+				value = self.items[key]
+			except KeyError:
+				self.misses += 1
+				return default
+
+			self.items.move_to_end(key)
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		"""Adds key to the cache, dropping the least recently used item if the cache is full"""
+		if self.maxsize <= 0:
+			return
+
+		with self.lock:
+			self.items[key] = value
+			self.items.move_to_end(key)
+
+			if len(self.items) > self.maxsize:
+				self.items.popitem(last = False)
+
+	def stats(self):
+		"""Returns a CacheStats of the hit and miss counts and the current and maximum size"""
+		with self.lock:
+			return CacheStats(self.hits, self.misses, len(self.items), self.maxsize)
@@ -0,0 +1,229 @@
+import bisect
+import http.server
+import threading
+import time
+
+# Port on localhost to serve the metrics on in the Prometheus text format, 0 to not serve them
+port = 0
+
+# Bucket upper bounds in seconds for latencies, from half a millisecond to ten seconds
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# All metrics, in the order they were created
+registry = []
+registry_lock = threading.Lock()
+
+started = time.monotonic()
+
+def initialize(*, config):
+	global port
+
+	if 'metrics' in config:
+		port = config['metrics'].getint('port', port)
+
+	if port != 0:
+		serve(port)
+
+# register(metric)
+# Add metric to the registry. A metric of the same name replaces the old one in place, so that setting things up again
+# (like initialize() being called twice) doesn't export the same metric twice
+def register(metric):
+	with registry_lock:
+		for index, registered in enumerate(registry):
+			if registered.name == metric.name:
+				registry[index] = metric
+				return
+
+		registry.append(metric)
+
+class Counter:
+	"""Count of things that have happened, for each combination of label values."""
+
+	metric_type = 'counter'
+
+	def __init__(self, name, help, labels = ()):
+		self.name = name
+		self.help = help
+		self.labels = labels
+
+		self.values = {}
+		self.lock = threading.Lock()
+
+		register(self)
+
+	def inc(self, *label_values, amount = 1):
+		with self.lock:
+			self.values[label_values] = self.values.get(label_values, 0) + amount
+
+	def samples(self):
+		"""Returns a list of (label values, value)"""
+		with self.lock:
+			return list(self.values.items())
+
+class Histogram:
+	"""Distribution of observed values over buckets, for each combination of label values."""
+
+	metric_type = 'histogram'
+
+	def __init__(self, name, help, labels = (), buckets = latency_buckets):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.buckets = buckets
+
+		# Label values → [count for each bucket and one for the rest, sum of the values]
+		self.values = {}
+		self.lock = threading.Lock()
+
+		register(self)
+
+	def observe(self, value, *label_values):
+		index = bisect.bisect_left(self.buckets, value)
+
+		with self.lock:
+			entry = self.values.get(label_values)
+			if entry is None:
+				entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+
+			entry[0][index] += 1
+			entry[1] += value
+
+	def samples(self):
+		"""Returns a list of (label values, (cumulative bucket counts, sum, count))"""
+		samples = []
+		with self.lock:
+			for label_values, (counts, total) in self.values.items():
+				cumulative = []
+				count = 0
+				for bucket_count in counts:
+					count += bucket_count
+					cumulative.append(count)
+
+				samples.append((label_values, (cumulative, total, count)))
+
+		return samples
+
+	def quantile(self, cumulative, count, q):
+		"""Upper bound of the bucket the q-quantile falls in, or None if it's past the last bucket"""
+		for bucket, bucket_count in zip(self.buckets, cumulative):
+			if bucket_count >= q * count:
+				return bucket
+
+		return None
+
+class Gauge:
+	"""Values read by calling function when the metrics are collected, so keeping them costs nothing in between.
+	function() returns a list of (label values, value). Values that only grow can be exported as counters."""
+
+	def __init__(self, name, help, labels, function, metric_type = 'gauge'):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.function = function
+		self.metric_type = metric_type
+
+		register(self)
+
+	def samples(self):
+		return self.function()
+
+# format_labels(names, values, extra = ()) → text
+def format_labels(names, values, extra = ()):
+	pairs = list(zip(names, values)) + list(extra)
+	if len(pairs) == 0:
+		return ''
+
+	def escape(value):
+		return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+	return '{' + ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs) + '}'
+
+# exposition() → text
+# All the metrics in the Prometheus text format
+def exposition():
+	with registry_lock:
+		metrics = list(registry)
+
+	lines = []
+	for metric in metrics:
+		lines.append('# HELP %s %s' % (metric.name, metric.help))
+		lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+
+		for label_values, value in metric.samples():
+			if metric.metric_type == 'histogram':
+				cumulative, total, count = value
+				for bucket, bucket_count in zip(metric.buckets + ('+Inf',), cumulative):
+					lines.append('%s_bucket%s %s' % (metric.name, format_labels(metric.labels, label_values, [('le', bucket)]), bucket_count))
+				lines.append('%s_sum%s %s' % (metric.name, format_labels(metric.labels, label_values), total))
+				lines.append('%s_count%s %s' % (metric.name, format_labels(metric.labels, label_values), count))
+
+			else:
+				lines.append('%s%s %s' % (metric.name, format_labels(metric.labels, label_values), value))
+
+	return ''.join(line + '\n' for line in lines)
+
+# summary(name_filter = '') → text
+# Short human readable summary of the metrics with name_filter in their name, to fit in a few IRC lines
+def summary(name_filter = ''):
+	with registry_lock:
+		metrics = [metric for metric in registry if name_filter in metric.name]
+
+	uptime = time.monotonic() - started
+
+	parts = []
+	for metric in metrics:
+		# Leave out the common prefix
+		name = metric.name.split('_', 1)[-1]
+
+		for label_values, value in sorted(metric.samples(), key = lambda sample: sample[0]):
+			label = ','.join(str(label_value) for label_value in label_values if label_value != '')
+			if label != '':
+				name_with_label = '%s[%s]' % (name, label)
+			else:
+				name_with_label = name
+
+			if metric.metric_type == 'histogram':
+				cumulative, total, count = value
+				if count == 0:
+					continue
+
+				def milliseconds(bound):
+					if bound is None:
+						return '>%gms' % (metric.buckets[-1] * 1000)
+					return '%gms' % (bound * 1000)
+
+				median = milliseconds(metric.quantile(cumulative, count, 0.5))
+				tail = milliseconds(metric.quantile(cumulative, count, 0.99))
+				parts.append('%s %i (p50 %s, p99 %s)' % (name_with_label, count, median, tail))
+
+			elif metric.metric_type == 'counter':
+				parts.append('%s %i (%.2f/s)' % (name_with_label, value, value / uptime))
+
+			else:
+				parts.append('%s %s' % (name_with_label, value))
+
+	if len(parts) == 0:
+		return 'No metrics'
+
+	return '; '.join(parts)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+	def do_GET(self):
+		body = exposition().encode('utf-8')
+
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		# Scrapes would flood stderr otherwise
+		pass
+
+# serve(port)
+# Serve the metrics over HTTP on localhost in a daemon thread
+def serve(port):
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+	server.daemon_threads = True
+	threading.Thread(target = server.serve_forever, daemon = True).start()
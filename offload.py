@@ -0,0 +1,220 @@
+import configparser
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+# Commands run in worker processes instead of the line handling threads, so that long glosses and searches don't
+# hold the GIL of the process that talks to the servers. Empty to run everything in threads
+commands = set()
+processes = 2
+
+# Seconds a command can take, from waiting for a free worker to getting the response, before it is given up on
+# A worker that runs out of time is killed and replaced
+# Command name → seconds, for commands with a timeout of their own
+timeout = 5.0
+timeouts = {}
+
+# Seconds a new worker can take to load the lexicon
+startup_timeout = 60.0
+
+# Workers are spawned rather than forked, since forking a process with threads running can leave locks held
+context = multiprocessing.get_context('spawn')
+
+# Workers that have loaded the lexicon and are waiting for a command, None if offloading is off
+idle_workers = None
+
+# All running workers, to stop them on shutdown. Workers that fail to start are removed, and once none are left
+# commands are run in threads again
+workers = []
+workers_lock = threading.Lock()
+closed = False
+
+timeouts_total = metrics.Counter('hynneflip_offload_timeouts_total', 'Offloaded commands given up on for taking too long', ['command'])
+metrics.Gauge('hynneflip_offload_idle_workers', 'Worker processes waiting for a command', [], lambda: [((), idle_workers.qsize())] if idle_workers is not None else [])
+
+class Timeout(Exception): None
+class Cancelled(Exception): None
+class WorkerError(Exception): None
+
+def initialize(*, config):
+	global commands, processes, timeout, idle_workers
+
+	if 'offload' in config:
+		commands = set(config['offload'].get('commands', '').split())
+		processes = config['offload'].getint('processes', processes)
+		timeout = config['offload'].getfloat('timeout', timeout)
+
+		for command in commands:
+			if command + '_timeout' in config['offload']:
+				timeouts[command] = config['offload'].getfloat(command + '_timeout')
+
+	if len(commands) == 0 or processes <= 0:
+		return
+
+	# Only the lexicon settings are passed on, since the workers do nothing but run commands
+	lexicon_settings = dict(config['lexicon']) if 'lexicon' in config else {}
+
+	idle_workers = queue.Queue()
+	for _ in range(processes):
+		Worker(lexicon_settings)
+
+class Worker:
+	"""A process with a copy of the lexicon of its own, running one command at a time. It puts itself in
+	idle_workers once it has loaded the lexicon."""
+
+	def __init__(self, lexicon_settings):
+		self.lexicon_settings = lexicon_settings
+
+		self.connection, child_connection = context.Pipe()
+		self.process = context.Process(target = worker_main, args = (child_connection, lexicon_settings), daemon = True)
+		self.process.start()
+		child_connection.close()
+
+		with workers_lock:
+			workers.append(self)
+
+		threading.Thread(target = self.wait_ready, daemon = True).start()
+
+	def wait_ready(self):
+		"""Wait for the process to load the lexicon, then make the worker available"""
+		try:
+			if self.connection.poll(startup_timeout):
+				self.connection.recv()
+				idle_workers.put(self)
+				return
+
+			reason = 'took over %s seconds to start' % startup_timeout
+
+		except (EOFError, OSError):
+			reason = 'exited while starting'
+
+		# Don't start another one, since it would most likely fail the same way
+		self.stop()
+		with workers_lock:
+			if self in workers:
+				workers.remove(self)
+			left = len(workers)
+
+		if not closed:
+			print('Offload worker process %s, %i workers left' % (reason, left), file = sys.stderr)
+
+	def call(self, command, timeout):
+		"""Run command and return its response. Raises Timeout if it isn't done in timeout seconds"""
+		self.connection.send(command)
+		if not self.connection.poll(timeout):
+			raise Timeout
+
+		succeeded, result = self.connection.recv()
+		if not succeeded:
+			raise WorkerError(result)
+
+		return result
+
+	def stop(self):
+		"""Kill the process, cancelling whatever it is doing"""
+		self.process.terminate()
+		self.process.join()
+
+	def respawn(self):
+		"""Stop this worker and start a fresh one to replace it"""
+		self.stop()
+		self.connection.close()
+
+		# Don't start new workers once shutting down. The new one is started first, so that there are workers
+		# left all along for offloaded()
+		if not closed:
+			Worker(self.lexicon_settings)
+
+		with workers_lock:
+			workers.remove(self)
+
+# worker_main(connection, lexicon_settings)
+# Load the lexicon, then run the commands received from connection until it is closed
+def worker_main(connection, lexicon_settings):
+	# botcmd imports this module, so it is only needed in the workers
+	import botcmd
+
+	# The console's ^C is meant for the bot, which stops the workers itself
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+	config = configparser.ConfigParser()
+	config.read_dict({'lexicon': lexicon_settings})
+	botcmd.initialize(config = config)
+	connection.send(True)
+
+	while True:
+		try:
+			command = connection.recv()
+		except EOFError:
+			break
+
+		# Pick up changes to the lexicon files, like the bot does
+		botcmd.check_lexicon_files()
+
+		try:
+			connection.send((True, botcmd.handle_command(command)))
+		except Exception:
+			connection.send((False, traceback.format_exc()))
+
+# offloaded(name) → offloaded
+# Whether the command called name is run in the workers. Not once all of them have failed to start
+def offloaded(name):
+	return idle_workers is not None and name in commands and len(workers) > 0
+
+# run(name, command) → response
+# Run the command line command, whose name is name, on a free worker and wait for the response
+# Raises Timeout if it takes too long, in which case the worker is replaced, Cancelled if shut down meanwhile, and
+# WorkerError if the command failed or the worker died
+def run(name, command):
+	deadline = time.monotonic() + timeouts.get(name, timeout)
+
+	try:
+		worker = idle_workers.get(timeout = deadline - time.monotonic())
+	except (queue.Empty, ValueError):
+		# ValueError if the deadline passed already
+		timeouts_total.inc(name)
+		raise Timeout
+
+	if closed:
+		raise Cancelled
+
+	try:
+		response = worker.call(command, max(0, deadline - time.monotonic()))
+
+	except Timeout:
+		timeouts_total.inc(name)
+		worker.respawn()
+		raise
+
+	except (EOFError, OSError):
+		if closed:
+			raise Cancelled
+
+		# The worker died under us
+		worker.respawn()
+		raise WorkerError('Worker process for %s exited' % name)
+
+	except WorkerError:
+		# The command failed, but the worker is fine
+		idle_workers.put(worker)
+		raise
+
+	idle_workers.put(worker)
+	return response
+
+# shutdown()
+# Stop the workers, cancelling the commands running on them
+def shutdown():
+	global closed
+
+	closed = True
+
+	with workers_lock:
+		for worker in workers:
+			worker.stop()
@@ -0,0 +1,334 @@
+import array
+import collections.abc
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import lexicon_cache
+
+# Shared lexicon file layout:
+#   header | section table | sections
+#   header: magic (8 bytes) | version (u32) | little endian (u32) | source mtime in ns (u64) | source size (u64) |
+#           source SHA-256 (32 bytes) | average field lengths (2 × f64) | section count (u32)
+#   section table: offset and length (u64 each) of every section. Sections start at multiples of 8 bytes
+# The string table is UTF-8 text, all other sections are arrays of native u32
+#
+# Unlike the compiled lexicon of lexicon_cache, the file is not unpickled but mapped read-only and used in place.
+# Attaching to it takes next to no time, and all processes attached to it share the same pages of memory. Only the
+# strings that get looked up are decoded into objects of their own
+magic = b'HFLEXS\0\0'
+# Bump whenever the layout of the file or how its contents are built changes
+version = 2
+
+header_format = '<8sIIQQ32sddI'
+header_size = struct.calcsize(header_format)
+section_format = '<QQ'
+section_size = struct.calcsize(section_format)
+
+class Strings:
+	"""Strings stored as UTF-8 one after another, with offsets[i] to offsets[i + 1] being string i."""
+
+	def __init__(self, text, offsets):
+		self.text = text
+		self.offsets = offsets
+
+	def __getitem__(self, index):
+		return str(self.raw(index), 'utf-8')
+
+	def raw(self, index):
+		"""The encoded string, without decoding it"""
+		return self.text[self.offsets[index]:self.offsets[index + 1]]
+
+class Records(collections.abc.Sequence):
+	"""Records of width u32 fields each. Returns them as tuples of the fields, or as record(fields) if given."""
+
+	def __init__(self, fields, width, record = None):
+		self.fields = fields
+		self.width = width
+		self.record = record
+
+	def __len__(self):
+		return len(self.fields) // self.width
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError(index)
+
+		fields = tuple(self.fields[index * self.width:(index + 1) * self.width])
+		return fields if self.record is None else self.record(fields)
+
+	def __iter__(self):
+		# Group the fields without going through __getitem__ for each record
+		fields = iter(self.fields)
+		records = zip(*[fields] * self.width)
+		return records if self.record is None else map(self.record, records)
+
+class HashIndex(collections.abc.Mapping):
+	"""Hash table from strings to u32 numbers, with linear probing. The first u32 is the number of keys, followed by
+	pairs of key string + 1 (0 for an empty slot) and number. Returns the numbers as value(number) if given."""
+
+	def __init__(self, table, strings, value = None):
+		self.count = table[0]
+		self.slots = table[1:]
+		self.mask = len(self.slots) // 2 - 1
+		self.strings = strings
+		self.value = value
+
+	def find(self, key):
+		"""The number stored for key, or None"""
+		encoded = key.encode('utf-8')
+
+		slot = zlib.crc32(encoded) & self.mask
+		while True:
+			key_string = self.slots[2 * slot]
+			if key_string == 0:
+				return None
+
+			if self.strings.raw(key_string - 1) == encoded:
+				return self.slots[2 * slot + 1]
+
+			slot = (slot + 1) & self.mask
+
+	def __getitem__(self, key):
+		number = self.find(key)
+		if number is None:
+			raise KeyError(key)
+
+		return number if self.value is None else self.value(number)
+
+	def __contains__(self, key):
+		return self.find(key) is not None
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		for slot in range(self.mask + 1):
+			key_string = self.slots[2 * slot]
+			if key_string != 0:
+				yield self.strings[key_string - 1]
+
+class StringTableBuilder:
+	"""Collects the strings for a string table, storing each distinct string once."""
+
+	def __init__(self):
+		self.ids = {}
+		self.text = bytearray()
+		self.offsets = array.array('I', [0])
+
+	def add(self, string):
+		"""Returns the index of string in the table"""
+		if string not in self.ids:
+			self.ids[string] = len(self.ids)
+			self.text += string.encode('utf-8')
+			self.offsets.append(len(self.text))
+
+		return self.ids[string]
+
+# build_hash_index(strings, items) → table
+# Build a HashIndex table from (string, number) pairs, adding the strings to the StringTableBuilder strings
+def build_hash_index(strings, items):
+	items = list(items)
+
+	# Keep the table at most half full, so that probe sequences stay short
+	size = 2
+	while size < 2 * len(items):
+		size *= 2
+
+	table = array.array('I', [0]) * (1 + 2 * size)
+	table[0] = len(items)
+
+	for key, number in items:
+		slot = zlib.crc32(key.encode('utf-8')) & (size - 1)
+		while table[1 + 2 * slot] != 0:
+			slot = (slot + 1) & (size - 1)
+
+		table[1 + 2 * slot] = strings.add(key) + 1
+		table[2 + 2 * slot] = number
+
+	return table
+
+# build_lists(lists, width) → offsets, fields
+# Store lists of records of width u32 fields (or of numbers, if width is 1) one after another
+# List i is fields[offsets[i] * width:offsets[i + 1] * width]
+def build_lists(lists, width):
+	offsets = array.array('I', [0])
+	fields = array.array('I')
+
+	for records in lists:
+		for record in records:
+			if width == 1:
+				fields.append(record)
+			else:
+				fields.extend(record)
+
+		offsets.append(len(fields) // width)
+
+	return offsets, fields
+
+# list_view(offsets, fields, width) → function
+# Returns a function giving the lists stored by build_lists as Records, or as plain u32 views if width is 1
+def list_view(offsets, fields, width):
+	if width == 1:
+		return lambda index: fields[offsets[index]:offsets[index + 1]]
+
+	return lambda index: Records(fields[offsets[index] * width:offsets[index + 1] * width], width)
+
+def align(offset):
+	return (offset + 7) & ~7
+
+# write(path, source_path, sections, average_field_lengths)
+# Write a shared lexicon file for source_path. Failing to write is not an error, we just won't have one
+def write(path, source_path, sections, average_field_lengths = (0, 0)):
+	try:
+		source_stat = os.stat(source_path)
+		checksum = lexicon_cache.source_checksum(source_path)
+
+		sections = [bytes(section) if not isinstance(section, array.array) else section.tobytes() for section in sections]
+
+		header = struct.pack(header_format, magic, version, sys.byteorder == 'little', source_stat.st_mtime_ns, source_stat.st_size, checksum, *average_field_lengths, len(sections))
+
+		offset = header_size + section_size * len(sections)
+		section_table = b''
+		for section in sections:
+			offset = align(offset)
+			section_table += struct.pack(section_format, offset, len(section))
+			offset += len(section)
+
+		def write_sections(f):
+			f.write(header)
+			f.write(section_table)
+			for section in sections:
+				f.write(b'\0' * (align(f.tell()) - f.tell()))
+				f.write(section)
+
+		# Move a new file in place rather than writing over the old one. Processes still attached to it keep using it
+		lexicon_cache.replace_file(path, write_sections)
+
+	except OSError:
+		pass
+
+# read(path, source_path) → sections, average_field_lengths
+# Map the shared lexicon file for source_path into memory. Returns None if it is missing, unreadable or stale
+def read(path, source_path):
+	try:
+		with open(path, 'rb') as f:
+			mapping = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		source_stat = os.stat(source_path)
+	except (OSError, ValueError):
+		# mmap raises ValueError for empty files
+		return None
+
+	if len(mapping) < header_size:
+		return None
+
+	file_magic, file_version, little_endian, source_mtime, source_size, checksum, *average_field_lengths, section_count = struct.unpack_from(header_format, mapping)
+
+	if file_magic != magic or file_version != version or little_endian != (sys.byteorder == 'little'):
+		return None
+
+	if source_mtime != source_stat.st_mtime_ns or source_size != source_stat.st_size:
+		# The source has been touched, but might still have the same contents (e.g. after a checkout)
+		try:
+			if lexicon_cache.source_checksum(source_path) != checksum:
+				return None
+		except OSError:
+			return None
+
+	view = memoryview(mapping)
+	sections = []
+	for index in range(section_count):
+		offset, length = struct.unpack_from(section_format, mapping, header_size + index * section_size)
+		if offset + length > len(mapping):
+			return None
+
+		sections.append(view[offset:offset + length])
+
+	return sections, tuple(average_field_lengths)
+
+# store_hymmnos(path, source_path, lexicon)
+# Write the HymmnosLexicon lexicon built from source_path into a shared lexicon file
+def store_hymmnos(path, source_path, lexicon):
+	strings = StringTableBuilder()
+
+	entries = array.array('I', (strings.add(field) for entry in lexicon.entries for field in entry))
+	meanings = array.array('I', (strings.add(meaning) for meaning in lexicon.meanings))
+	by_hymmnos = build_hash_index(strings, lexicon.by_hymmnos.items())
+
+	trigram_keys = list(lexicon.trigrams)
+	trigram_offsets, trigram_fields = build_lists((lexicon.trigrams[key] for key in trigram_keys), 1)
+	trigrams = build_hash_index(strings, ((key, index) for index, key in enumerate(trigram_keys)))
+
+	posting_keys = list(lexicon.postings)
+	posting_offsets, posting_fields = build_lists((lexicon.postings[key] for key in posting_keys), 3)
+	postings = build_hash_index(strings, ((key, index) for index, key in enumerate(posting_keys)))
+
+	field_lengths = array.array('I', (length for lengths in lexicon.field_lengths for length in lengths))
+
+	sections = [strings.text, strings.offsets, entries, meanings, by_hymmnos, trigram_offsets, trigram_fields, trigrams, posting_offsets, posting_fields, postings, field_lengths]
+	write(path, source_path, sections, lexicon.average_field_lengths)
+
+# attach_hymmnos(path, source_path, entry_type, lexicon_type) → lexicon
+# Attach to the shared lexicon file for source_path, returning a lexicon_type whose parts are read-only views of it
+# Returns None if the file is missing, unreadable or stale
+def attach_hymmnos(path, source_path, entry_type, lexicon_type):
+	contents = read(path, source_path)
+	if contents is None:
+		return None
+
+	sections, average_field_lengths = contents
+
+	try:
+		text, *numbers = sections
+		string_offsets, entries, meanings, by_hymmnos, trigram_offsets, trigram_fields, trigrams, posting_offsets, posting_fields, postings, field_lengths = (section.cast('I') for section in numbers)
+	except (ValueError, TypeError):
+		# Wrong number of sections or sections of the wrong size, just rebuild
+		return None
+
+	strings = Strings(text, string_offsets)
+
+	return lexicon_type(
+		Records(entries, len(entry_type._fields), lambda fields: entry_type(*(strings[field] for field in fields))),
+		HashIndex(by_hymmnos, strings),
+		Records(meanings, 1, lambda fields: strings[fields[0]]),
+		HashIndex(trigrams, strings, list_view(trigram_offsets, trigram_fields, 1)),
+		HashIndex(postings, strings, list_view(posting_offsets, posting_fields, 3)),
+		Records(field_lengths, 2),
+		average_field_lengths
+	)
+
+# store_emotions(path, source_path, emotions)
+# Write the emotion lexicon read from source_path into a shared lexicon file
+def store_emotions(path, source_path, emotions):
+	strings = StringTableBuilder()
+
+	keys = list(emotions)
+	records = array.array('I', (strings.add(field) for key in keys for field in emotions[key]))
+	index = build_hash_index(strings, ((key, number) for number, key in enumerate(keys)))
+
+	write(path, source_path, [strings.text, strings.offsets, records, index])
+
+# attach_emotions(path, source_path, emotion_type) → emotions
+# Attach to the shared emotion lexicon file for source_path, returning a read-only mapping of emotion_types
+# Returns None if the file is missing, unreadable or stale
+def attach_emotions(path, source_path, emotion_type):
+	contents = read(path, source_path)
+	if contents is None:
+		return None
+
+	sections, _ = contents
+
+	try:
+		text, *numbers = sections
+		string_offsets, records, index = (section.cast('I') for section in numbers)
+	except (ValueError, TypeError):
+		return None
+
+	strings = Strings(text, string_offsets)
+	records = Records(records, len(emotion_type._fields), lambda fields: emotion_type(*(strings[field] for field in fields)))
+
+	return HashIndex(index, strings, records.__getitem__)
@@ -0,0 +1,115 @@
+import contextlib
+import threading
+import time
+
+import metrics
+from constants import logmessage_types, internal_submessage_types
+
+# Whether to trace lines at all, and how long in seconds handling one can take before its trace is logged
+enabled = True
+slow_threshold = 1.0
+
+request_seconds = metrics.Histogram('hynneflip_request_seconds', 'Time from reading a line to writing the last reply to it')
+
+local = threading.local()
+
+def initialize(*, config):
+	global enabled, slow_threshold
+
+	if 'tracing' in config:
+		enabled = config['tracing'].getboolean('enabled', enabled)
+		slow_threshold = config['tracing'].getfloat('slow_threshold', slow_threshold)
+
+class Trace:
+	"""Timestamps of the stages a received line goes through, until the replies to it have been written.
+	Everything still working on the line holds a reference to the trace: the reader until it has dispatched the
+	line, each handler until it returns, and each reply line until it has been written. The trace is finished
+	when the last reference is released."""
+
+	def __init__(self, read_time, logging_channel):
+		self.logging_channel = logging_channel
+		self.description = ''
+
+		self.stages = [('read', read_time)]
+		self.references = 1
+		self.lock = threading.Lock()
+
+	def mark(self, stage):
+		with self.lock:
+			self.stages.append((stage, time.monotonic()))
+
+	def hold(self, stage):
+		"""Mark stage and take a reference, for work that continues elsewhere"""
+		with self.lock:
+			self.stages.append((stage, time.monotonic()))
+			self.references += 1
+
+	def release(self, stage = None):
+		"""Mark stage (unless None) and give up a reference, finishing the trace if it was the last"""
+		with self.lock:
+			if stage is not None:
+				self.stages.append((stage, time.monotonic()))
+
+			self.references -= 1
+			if self.references > 0:
+				return
+
+		self.finish()
+
+	def finish(self):
+		# Lines that were dropped before parsing, since nothing would handle them, aren't requests
+		if len(self.stages) == 1:
+			return
+
+		# Stages marked from different threads can be slightly out of order
+		stages = sorted(self.stages, key = lambda stage: stage[1])
+		read_time = stages[0][1]
+		total = stages[-1][1] - read_time
+
+		request_seconds.observe(total)
+
+		if total >= slow_threshold:
+			breakdown = []
+			previous_time = read_time
+			for stage, stage_time in stages[1:]:
+				breakdown.append('%s +%.1fms' % (stage, (stage_time - previous_time) * 1000))
+				previous_time = stage_time
+
+			text = '%.1fms %s: %s' % (total * 1000, self.description, ', '.join(breakdown))
+			self.logging_channel.send((logmessage_types.internal, internal_submessage_types.slow, text))
+
+# start(read_time, logging_channel) → trace
+# Returns a new trace for a line read at read_time, or None if tracing is disabled
+def start(read_time, logging_channel):
+	if not enabled:
+		return None
+
+	return Trace(read_time, logging_channel)
+
+# current() → trace
+# The trace of the line the handler running in this thread is handling, or None
+def current():
+	return getattr(local, 'trace', None)
+
+# mark(stage)
+# Mark stage on the trace of the current handler, if there is one
+def mark(stage):
+	trace = current()
+	if trace is not None:
+		trace.mark(stage)
+
+@contextlib.contextmanager
+def activate(trace):
+	"""Make trace current in this thread for running a handler, which holds a reference to it"""
+	if trace is None:
+		yield
+		return
+
+	local.trace = trace
+	trace.mark('handler start')
+
+	try:
+		yield
+	finally:
+		local.trace = None
+		trace.release('handler end')